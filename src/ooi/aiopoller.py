@@ -0,0 +1,234 @@
+"""
+event loop versions of the pollers in ooi.poller: checks run from the asyncio event loop's timers, without any threads
+
+    poller = AsyncConditionPoller(condition, callback, exception_callback, interval=5)
+    poller.start()
+
+iterate new files in a directory:
+    iterator = AsyncDirectoryIterator('/tmp', 'A*.DAT')
+    async for filename in iterator:                 # python 3.5+
+        ...
+or on python 2 with trollius:
+    filename = yield From(iterator.get())
+
+condition and callback may also return a coroutine or future, the next check is scheduled when it completes.
+with inotify, AsyncDirectoryPoller adds the inotify file descriptor to the event loop, so new files are reported immediately.
+"""
+
+import os
+from collections import deque
+from ooi.logging import log
+from ooi.poller import DirectoryPoller
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio # python 2
+    except ImportError:
+        asyncio = None
+
+try:
+    StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        """ python 2: raised by future from get() after iteration ends (StopIteration would end the waiting coroutine) """
+
+def _new_future(loop):
+    return loop.create_future() if hasattr(loop, 'create_future') else asyncio.Future(loop=loop)
+
+class AsyncConditionPoller(object):
+    """
+    every interval seconds, check if condition returns a true value. if so, pass the value to callback
+    if condition or callback raise exception, stop polling and pass the exception to exception_callback.
+    """
+    def __init__(self, condition, condition_callback, exception_callback, interval, loop=None):
+        """
+        @param loop: event loop to run in, default asyncio.get_event_loop()
+        """
+        if asyncio is None:
+            raise ImportError('asyncio (or trollius on python 2) is required')
+        self.polling_interval = interval
+        self.is_shutting_down = False
+        self._condition = condition
+        self._callback = condition_callback
+        self._on_exception = exception_callback
+        self._loop = loop or asyncio.get_event_loop()
+        self._handle = None # next scheduled check
+        self._running = None # future returned by condition or callback, while waiting for it
+        self.done = _new_future(self._loop) # result set when polling stops
+
+    def start(self):
+        self._handle = self._loop.call_soon(self._check)
+
+    def shutdown(self):
+        if self.is_shutting_down:
+            return
+        self.is_shutting_down = True
+        if self._handle:
+            self._handle.cancel()
+        if self._running:
+            self._running.cancel()
+        self._on_stopped()
+        if not self.done.done():
+            self.done.set_result(None)
+
+    def wait(self):
+        """ @return: future that completes when polling stops """
+        return self.done
+
+    def _on_stopped(self):
+        pass
+
+    def _check(self):
+        self._handle = None
+        if self.is_shutting_down:
+            return
+        try:
+            value = self._condition()
+        except Exception as e:
+            self._fail(e)
+            return
+        self._then(value, self._on_value)
+
+    def _on_value(self, value):
+        if not value:
+            self._schedule()
+            return
+        try:
+            result = self._callback(value)
+        except Exception as e:
+            self._fail(e)
+            return
+        self._then(result, lambda result: self._schedule())
+
+    def _then(self, value, next_step):
+        """ call next_step with value, or with its result if value is a coroutine or future """
+        if asyncio.iscoroutine(value) or isinstance(value, asyncio.Future):
+            self._running = asyncio.ensure_future(value, loop=self._loop)
+            self._running.add_done_callback(lambda future: self._resume(future, next_step))
+        else:
+            next_step(value)
+
+    def _resume(self, future, next_step):
+        self._running = None
+        if future.cancelled() or self.is_shutting_down:
+            return
+        if future.exception() is not None:
+            self._fail(future.exception())
+        else:
+            next_step(future.result())
+
+    def _schedule(self):
+        if not self.is_shutting_down:
+            self._handle = self._loop.call_later(self.polling_interval, self._check)
+
+    def _fail(self, exception):
+        log.debug('stopping poller after exception: %r', exception)
+        self.shutdown()
+        if self._on_exception:
+            self._on_exception(exception)
+
+class AsyncDirectoryPoller(AsyncConditionPoller):
+    """ report new files added to a directory that match a wildcard pattern, as DirectoryPoller """
+    def __init__(self, directory, wildcard, callback, exception_callback=None, interval=1, inotify=True, loop=None, ready=None):
+        """
+        @param ready: readiness policy that holds back files until they are complete (see DirectoryPoller)
+        """
+        if not os.path.isdir(directory):
+            raise ValueError('%s is not a directory'%directory)
+        # only used to check the directory, its thread is never started
+        self._source = DirectoryPoller(directory, wildcard, None, None, interval, inotify, ready=ready)
+        self._reading = False
+        super(AsyncDirectoryPoller,self).__init__(self._source._condition, callback, exception_callback, interval, loop)
+
+    def start(self):
+        super(AsyncDirectoryPoller,self).start()
+        self._watch()
+
+    def _watch(self):
+        fd = self._source._fileno()
+        if fd is not None and not self._reading and not self.is_shutting_down:
+            self._loop.add_reader(fd, self._on_readable)
+            self._reading = True
+
+    def _unwatch(self):
+        if self._reading:
+            self._loop.remove_reader(self._source._fileno())
+            self._reading = False
+
+    def _on_readable(self):
+        if self._running:
+            self._unwatch() # still handling last files: watch again when done
+            return
+        if self._handle:
+            self._handle.cancel()
+        self._check()
+
+    def _schedule(self):
+        super(AsyncDirectoryPoller,self)._schedule()
+        self._watch()
+
+    def _on_stopped(self):
+        self._unwatch()
+        self._source._on_stopped()
+
+class AsyncDirectoryIterator(object):
+    """
+    asynchronous iterator of new files added to a directory, as BlockingDirectoryIterator
+
+    each get() (or each step of async for) returns a future of the next filename.
+    if polling stops with an exception, the future raises it; after cancel(), iteration ends.
+    """
+    _DONE = object()
+
+    def __init__(self, directory, wildcard, interval=1, inotify=True, loop=None, ready=None):
+        self._items = deque()
+        self._waiter = None
+        self._poller = AsyncDirectoryPoller(directory, wildcard, self._on_condition, self._on_exception, interval, inotify, loop, ready)
+        self._loop = self._poller._loop
+        self._poller.start()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.get()
+
+    def get(self):
+        """ @return: future of next filename """
+        future = _new_future(self._loop)
+        if self._items:
+            self._deliver(future)
+        else:
+            self._waiter = future
+        return future
+
+    def cancel(self):
+        self._poller.shutdown()
+        self._put(self._DONE)
+
+    def _put(self, item):
+        self._items.append(item)
+        if self._waiter and not self._waiter.done(): # consumer may have cancelled its wait
+            self._deliver(self._waiter)
+        self._waiter = None
+
+    def _deliver(self, future):
+        item = self._items[0]
+        if item is self._DONE:
+            future.set_exception(StopAsyncIteration())
+            return
+        self._items.popleft()
+        if isinstance(item, Exception):
+            self._items.appendleft(self._DONE) # iteration ends after exception
+            future.set_exception(item)
+        else:
+            future.set_result(item)
+
+    def _on_condition(self, filenames):
+        for filename in filenames:
+            self._put(filename)
+
+    def _on_exception(self, exception):
+        self._put(exception)
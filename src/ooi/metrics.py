@@ -0,0 +1,208 @@
+"""
+export persisted Accumulators and Meters (see ooi.timer.get_accumulators and get_meters) for monitoring tools
+
+render all of them as Prometheus text format or JSON:
+    text = to_prometheus()
+    data = to_json()
+
+serve both from a local HTTP endpoint (/metrics and /metrics.json):
+    server = MetricsServer(port=9100)
+    server.start()
+
+or write them to a file every 30 seconds, replacing it atomically so readers never see a partial file:
+    writer = SnapshotWriter('/var/run/ooi/metrics.prom', interval=30)
+    writer.start()
+
+stats are copied under each accumulator's lock (for a sharded accumulator, each thread's stats under their own lock)
+and serialized after the lock is released, so exporting does not block threads adding values.
+"""
+
+import os
+import json
+import math
+import tempfile
+from threading import Thread, Event
+from ooi.logging import log
+from ooi.timer import get_accumulators, get_meters
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler # python 3
+
+def _number(value):
+    """ @return: value in prometheus text format """
+    if value!=value:
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value>0 else '-Inf'
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join([ '%s="%s"' % (key, _escape(value)) for key,value in sorted(labels.items()) ]) + '}'
+
+def _accumulator_stats(accumulator):
+    """ @return: list of (label, dict of stats) for one accumulator, read from a copy so no lock is held while formatting """
+    stats = accumulator._read_copy()
+    out = []
+    for label,count,mean,m2,min_value,max_value,histogram in sorted(stats.entries()):
+        # percentiles clamped to min..max, the same values str(accumulator) reports
+        out.append((label, { 'count': count, 'sum': mean*count, 'mean': mean,
+                             'stddev': math.sqrt(m2/count) if count>1 else float('nan'),
+                             'min': min_value, 'max': max_value,
+                             'percentiles': [ (q, stats.get_percentile(label, q)) for q in accumulator.percentiles ] }))
+    return out
+
+def _meter_rates(meter):
+    return { 'count': meter.get_count(), 'mean_rate': meter.get_mean_rate(), 'm1_rate': meter.get_one_minute_rate(),
+             'm5_rate': meter.get_five_minute_rate(), 'm15_rate': meter.get_fifteen_minute_rate() }
+
+def to_prometheus(accumulators=None, meters=None):
+    """ @return: string in prometheus text exposition format (version 0.0.4)
+        @param accumulators: dict of name -> Accumulator, default get_accumulators()
+        @param meters: dict of name -> Meter, default get_meters()
+    """
+    accumulators = get_accumulators() if accumulators is None else accumulators
+    meters = get_meters() if meters is None else meters
+    lines = []
+    if accumulators:
+        lines.append('# TYPE ooi_accumulator summary')
+        extra = { 'min': [], 'max': [], 'sample_rate': [] }
+        for name,accumulator in sorted(accumulators.items()):
+            for label,stats in _accumulator_stats(accumulator):
+                for q,value in stats['percentiles']:
+                    lines.append('ooi_accumulator' + _labels(accumulator=name, label=label, quantile=q/100.) + ' ' + _number(value))
+                lines.append('ooi_accumulator_sum' + _labels(accumulator=name, label=label) + ' ' + _number(stats['sum']))
+                lines.append('ooi_accumulator_count' + _labels(accumulator=name, label=label) + ' ' + _number(stats['count']))
+                extra['min'].append(('ooi_accumulator_min' + _labels(accumulator=name, label=label), stats['min']))
+                extra['max'].append(('ooi_accumulator_max' + _labels(accumulator=name, label=label), stats['max']))
+            if accumulator.sampler:
+                extra['sample_rate'].append(('ooi_accumulator_sample_rate' + _labels(accumulator=name), accumulator.sampler.rate))
+        for kind in 'min', 'max', 'sample_rate':
+            if extra[kind]:
+                lines.append('# TYPE ooi_accumulator_%s gauge' % kind)
+                lines += [ series + ' ' + _number(value) for series,value in extra[kind] ]
+    if meters:
+        rates = [ (name, _meter_rates(meter)) for name,meter in sorted(meters.items()) ]
+        lines.append('# TYPE ooi_meter_total counter')
+        lines += [ 'ooi_meter_total' + _labels(meter=name) + ' ' + _number(values['count']) for name,values in rates ]
+        lines.append('# TYPE ooi_meter_rate gauge')
+        for name,values in rates:
+            for window in 'mean', 'm1', 'm5', 'm15':
+                lines.append('ooi_meter_rate' + _labels(meter=name, window=window) + ' ' + _number(values[window+'_rate']))
+    return '\n'.join(lines) + '\n'
+
+def to_json(accumulators=None, meters=None):
+    """ @return: dict of plain values suitable for json.dumps, NaN values are None
+        @param accumulators: dict of name -> Accumulator, default get_accumulators()
+        @param meters: dict of name -> Meter, default get_meters()
+    """
+    accumulators = get_accumulators() if accumulators is None else accumulators
+    meters = get_meters() if meters is None else meters
+    def clean(value):
+        return None if value!=value else value
+    out = { 'accumulators': {}, 'meters': {} }
+    for name,accumulator in accumulators.items():
+        labels = out['accumulators'][name] = {}
+        for label,stats in _accumulator_stats(accumulator):
+            stats['percentiles'] = dict([ (str(q), clean(value)) for q,value in stats['percentiles'] ])
+            labels[label] = dict([ (key, value if key=='percentiles' else clean(value)) for key,value in stats.items() ])
+    for name,meter in meters.items():
+        out['meters'][name] = _meter_rates(meter)
+    return out
+
+def _render(format, accumulators=None, meters=None):
+    if format=='json':
+        return json.dumps(to_json(accumulators, meters), sort_keys=True)
+    elif format=='prometheus':
+        return to_prometheus(accumulators, meters)
+    raise ValueError('unknown metrics format: ' + format)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path=='/metrics':
+            body, content_type = _render('prometheus'), 'text/plain; version=0.0.4'
+        elif path=='/metrics.json':
+            body, content_type = _render('json'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('metrics request: ' + format, *args)
+
+class MetricsServer(Thread):
+    """ daemon thread serving /metrics (prometheus) and /metrics.json over HTTP """
+    def __init__(self, port=9100, host='127.0.0.1'):
+        """
+        @param port: listen on this port (0 picks a free port, see self.port after creation)
+        @param host: listen on this address, default only local connections
+        """
+        super(MetricsServer,self).__init__(name='metrics-server')
+        self.daemon = True
+        self.server = HTTPServer((host, port), _MetricsHandler)
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self.ident is not None:
+            # waits for serve_forever to return: forever if this thread was never started
+            self.server.shutdown()
+        self.server.server_close()
+
+class SnapshotWriter(Thread):
+    """ daemon thread writing all metrics to a file every interval seconds
+
+        each snapshot is written to a temporary file in the same directory and renamed over the old one,
+        so readers see either the previous snapshot or the new one, never a partial file.
+    """
+    def __init__(self, filename, interval=60, format=None):
+        """
+        @param filename: file to write
+        @param interval: seconds between snapshots
+        @param format: 'prometheus' or 'json', default json if filename ends with .json
+        """
+        super(SnapshotWriter,self).__init__(name='metrics-snapshot')
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.format = format or ('json' if filename.endswith('.json') else 'prometheus')
+        _render(self.format, {}, {}) # fail now if format is not valid
+        self._stopped = Event()
+
+    def write(self):
+        """ write one snapshot now """
+        content = _render(self.format)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.filename))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(temp, 0o644) # mkstemp creates file readable only by owner
+            os.rename(temp, self.filename)
+        except:
+            os.remove(temp)
+            raise
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.write()
+            except:
+                log.error('failed to write metrics snapshot %s', self.filename, exc_info=True)
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
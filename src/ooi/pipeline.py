@@ -0,0 +1,228 @@
+"""
+process files found by a BlockingDirectoryIterator in parallel
+
+    files = BlockingDirectoryIterator('/data/incoming', '*.DAT')
+    for filename,result,exception in FilePipeline(files, parse_granule, workers=8):
+        if exception:
+            log.error('could not parse %s: %r', filename, exception)
+        else:
+            store(result)
+
+each file is passed to function in a pool of threads (or processes, for CPU-bound functions).
+at most max_in_flight files are being processed or waiting to be taken from results() at any time,
+so a slow consumer stops new files being submitted instead of letting results pile up in memory.
+with ordered=True results are yielded in the order files were found, otherwise as soon as each is done.
+
+an exception from function is returned with the result for that file, and processing continues with the next file.
+so is any other failure to process one file: with processes=True, a result that cannot be pickled,
+or a worker process that exited while processing it.
+an exception that stops the directory poller is raised from results() after files already submitted are yielded.
+after close(), results() returns without waiting for files still being processed.
+"""
+
+import os
+import pickle
+import functools
+from threading import Thread
+from Queue import Queue
+from time import sleep
+from multiprocessing.sharedctypes import RawArray
+from multiprocessing.pool import ThreadPool, Pool
+from ooi.logging import log
+
+_worker_pids = None # in each worker process: pid of the worker that started the file in each slot, see FilePipeline._watch
+
+def _init_worker(pids):
+    global _worker_pids
+    _worker_pids = pids
+
+def _process(function, filename):
+    """ run in worker: exceptions are returned instead of raised, so each file gets its own result """
+    try:
+        return filename, function(filename), None
+    except Exception as e:
+        log.warning('failed to process %s', filename, exc_info=True)
+        return filename, None, e
+
+def _process_pickled(function, filename, slot):
+    """ run in worker process: pickle result here, so one that cannot be pickled fails only this file
+        (the pool would drop it without calling back)
+    """
+    _worker_pids[slot] = os.getpid()
+    out = _process(function, filename)
+    try:
+        return pickle.dumps(out, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        log.warning('result for %s cannot be pickled', filename, exc_info=True)
+        return pickle.dumps((filename, None, pickle.PicklingError('result cannot be pickled: %r' % e)), pickle.HIGHEST_PROTOCOL)
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+class _Task(object):
+    """ a file submitted to the pool """
+    def __init__(self, filename, index, slot):
+        self.filename = filename
+        self.index = index # number of files submitted before this one
+        self.slot = slot # one of max_in_flight
+        self.pending = None # AsyncResult from the pool
+        self.value = None # returned by the worker
+        self.exception = None # set instead if the pool did not return a value
+        self.taken = False # received by results(), so later notices for this task are ignored
+
+class _End(object):
+    """ queued after the last file submitted """
+    def __init__(self, submitted, exception):
+        self.submitted = submitted
+        self.exception = exception
+
+class FilePipeline(object):
+    def __init__(self, files, function, workers=4, processes=False, max_in_flight=None, ordered=True):
+        """
+        @param files: BlockingDirectoryIterator, or any iterable of filenames
+        @param function: called with each filename, must be a module-level function if processes=True
+        @param workers: number of threads or processes
+        @param processes: use a pool of processes instead of threads
+        @param max_in_flight: most files submitted but not yet taken from results(), default 2*workers
+        @param ordered: yield results in the order files were found (True) or as they complete (False)
+        """
+        self.files = files
+        self.function = function
+        self.ordered = ordered
+        max_in_flight = max_in_flight or 2*workers
+        if processes:
+            self._pids = RawArray('i', max_in_flight)
+            self._pool = Pool(workers, _init_worker, (self._pids,))
+        else:
+            self._pool = ThreadPool(workers)
+        self._processes = processes
+        self._free = Queue() # slots not in use: feeder waits for one before submitting each file
+        for slot in xrange(max_in_flight):
+            self._free.put(slot)
+        self._tasks = {} # slot -> _Task submitted and not yet taken from results()
+        self._queue = Queue() # _Task when done or failed, _End after last file submitted, None when closed
+        self._feeder = None
+        self._closed = False
+
+    def __iter__(self):
+        return self.results()
+
+    def results(self):
+        """ yield (filename, result, exception) for each file, exception is None if function returned normally """
+        if not self._feeder:
+            self._feeder = Thread(target=self._feed, name='file-pipeline')
+            self._feeder.daemon = True
+            self._feeder.start()
+            if self._processes:
+                watcher = Thread(target=self._watch, name='file-pipeline-watcher')
+                watcher.daemon = True
+                watcher.start()
+        end = None
+        received = 0
+        done = {} # ordered: index -> task finished before an earlier file
+        while not end or received<end.submitted:
+            item = self._queue.get()
+            if self._closed:
+                return
+            if isinstance(item, _End):
+                end = item
+                continue
+            if item.taken:
+                continue
+            item.taken = True
+            done[item.index if self.ordered else received] = item
+            while received in done:
+                task = done.pop(received)
+                received += 1
+                del self._tasks[task.slot]
+                self._free.put(task.slot)
+                yield self._result(task)
+        if end.exception:
+            raise end.exception
+
+    def close(self):
+        """ stop polling and submitting files, stop the pool, and stop results() """
+        self._closed = True
+        self._free.put(None) # feeder may be waiting for a slot
+        self._queue.put(None) # results() may be waiting for a file
+        if hasattr(self.files, 'cancel'):
+            self.files.cancel()
+        if self._processes:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+
+    def _filenames(self):
+        return self.files.get_files() if hasattr(self.files, 'get_files') else iter(self.files)
+
+    def _feed(self):
+        submitted = 0
+        exception = None
+        try:
+            for filename in self._filenames():
+                slot = self._free.get()
+                if self._closed:
+                    break
+                task = self._tasks[slot] = _Task(filename, submitted, slot)
+                callback = functools.partial(self._done, task)
+                if self._processes:
+                    self._pids[slot] = 0
+                    task.pending = self._pool.apply_async(_process_pickled, (self.function, filename, slot), callback=callback)
+                else:
+                    task.pending = self._pool.apply_async(_process, (self.function, filename), callback=callback)
+                submitted += 1
+        except Exception as e:
+            if not self._closed:
+                log.debug('stopped submitting files after exception', exc_info=True)
+                exception = e
+        self._queue.put(_End(submitted, exception))
+
+    def _done(self, task, value):
+        """ called by the pool when the worker returns """
+        task.value = value
+        self._queue.put(task)
+
+    def _fail(self, task, exception):
+        task.exception = exception
+        self._queue.put(task)
+
+    def _watch(self, interval=0.2):
+        """ fail files the process pool will never call back for: it could not send them to a worker
+            (function cannot be pickled), or the worker exited while processing them
+        """
+        suspects = set() # worker not running, but its result may still be on the way: fail if still missing next time
+        while not self._closed and (self._feeder.is_alive() or self._tasks):
+            sleep(interval)
+            for task in self._tasks.values():
+                if task.pending is None or task.exception is not None:
+                    continue
+                if task.pending.ready():
+                    if not task.pending.successful():
+                        try:
+                            task.pending.get()
+                        except Exception as e:
+                            self._fail(task, e)
+                    continue
+                pid = self._pids[task.slot]
+                if pid and not _is_alive(pid):
+                    if task in suspects:
+                        log.warning('worker process %d exited while processing %s', pid, task.filename)
+                        self._fail(task, RuntimeError('worker process %d exited while processing %s' % (pid, task.filename)))
+                    else:
+                        suspects.add(task)
+            suspects.intersection_update(self._tasks.values())
+
+    def _result(self, task):
+        if task.exception is not None:
+            return task.filename, None, task.exception
+        if not self._processes:
+            return task.value
+        try:
+            return pickle.loads(task.value)
+        except Exception as e:
+            log.warning('result for %s cannot be unpickled', task.filename, exc_info=True)
+            return task.filename, None, e
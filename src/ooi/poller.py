@@ -1,38 +1,118 @@
 """
 polling utilities -- general polling for condition, polling for file to appear in a directory
+
+on linux, DirectoryPoller is told about new files by inotify as soon as they are closed after writing
+(or renamed into the directory), and only checks the whole directory when it starts or events were lost.
+elsewhere, or with inotify=False, it checks the directory every interval seconds.
 """
 import os
-import glob
-from threading import Thread
+import re
+import time
+import errno
+import select
+import struct
+import fnmatch
+import fcntl
+import heapq
+import itertools
+from collections import deque
+from threading import Thread, Lock
+from threading import Event as ThreadEvent
 from gevent.event import Event
 from ooi.logging import log
-from Queue import Queue
+from Queue import Queue, Empty
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1, _libc.inotify_add_watch # raise AttributeError if not linux
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+# from sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+_IN_NONBLOCK = 0x00000800
+_IN_CLOEXEC = 0x00080000
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, len -- followed by len bytes of name
+
+# directory mtime may not change for files added in the same clock tick as the last scan,
+# so only skip a scan if the directory had not changed for this long before the last scan
+_MTIME_MARGIN = 1.
+
+def _list_names(directory):
+    """ @return: names of entries in directory, using os.scandir where available (python 3.5+) """
+    if hasattr(os, 'scandir'):
+        return [ entry.name for entry in os.scandir(directory) ]
+    return os.listdir(directory)
 
 class ConditionPoller(Thread):
     """
     generic polling mechanism: every interval seconds, check if condition returns a true value. if so, pass the value to callback
     if condition or callback raise exception, stop polling.
+
+    by default each poller runs in its own thread.  to run many pollers in one thread, create them with a shared PollScheduler.
     """
-    def __init__(self, condition, condition_callback, exception_callback, interval):
-        self.polling_interval = interval
+    def __init__(self, condition, condition_callback, exception_callback, interval, scheduler=None,
+                 min_interval=None, max_interval=None, backoff=2.):
+        """
+        to adapt the interval to how often the condition is true, set min_interval and max_interval:
+        after each check that returns a value the interval is divided by backoff (down to min_interval),
+        after each check that returns nothing it is multiplied by backoff (up to max_interval).
+
+        @param scheduler: run checks in this PollScheduler instead of a new thread
+        @param min_interval: shortest interval while the condition keeps returning values (default interval)
+        @param max_interval: longest interval while the condition returns nothing (default interval)
+        @param backoff: factor to change interval by after each check
+        """
+        self.min_interval = interval if min_interval is None else min_interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self.backoff = backoff
+        self.polling_interval = min(self.max_interval, max(self.min_interval, interval))
+        self.checks = 0
+        self.found = 0 # checks that returned a value
+        self.check_seconds = 0. # total time taken by condition
+        self.max_check_seconds = 0.
         self._shutdown_now = Event()
         self._condition = condition
         self._callback = condition_callback
         self._on_exception = exception_callback
+        self._scheduler = scheduler
+        self._finished = ThreadEvent()
+        self._paused = False # set by subclasses while the consumer cannot take more values
         super(ConditionPoller,self).__init__()
     def shutdown(self):
         self.is_shutting_down = True
         self._shutdown_now.set()
+        if self._scheduler:
+            self._scheduler.remove(self)
     def run(self):
         try:
             while not self._shutdown_now.is_set():
                 self._check_condition()
-                self._shutdown_now.wait(self.polling_interval)
+                self._wait()
         except:
             log.error('thread failed', exc_info=True)
+        finally:
+            self._on_stopped()
+            self._finished.set()
+    def _wait(self):
+        self._shutdown_now.wait(self.polling_interval)
+    def _fileno(self):
+        """ @return: file descriptor that becomes readable when condition should be checked before interval ends, or None """
+        return None
+    def _on_stopped(self):
+        """ called once when polling has stopped, in the polling thread """
+        pass
     def _check_condition(self):
+        start = time.time()
         try:
             value = self._condition()
+            self._adapt(time.time()-start, value)
             if value:
                 self._callback(value)
         except Exception as e:
@@ -40,38 +120,448 @@ class ConditionPoller(Thread):
             self.shutdown()
             if self._on_exception:
                 self._on_exception(e)
+    def _adapt(self, elapsed, found):
+        self.checks += 1
+        self.check_seconds += elapsed
+        self.max_check_seconds = max(self.max_check_seconds, elapsed)
+        if found:
+            self.found += 1
+            self.polling_interval = max(self.min_interval, self.polling_interval/self.backoff)
+        else:
+            self.polling_interval = min(self.max_interval, self.polling_interval*self.backoff)
+    def get_stats(self):
+        """ @return: dict with current interval, number of checks and checks that found a value, average and max time of a check """
+        return { 'interval': self.polling_interval, 'checks': self.checks, 'found': self.found,
+                 'average_check_seconds': self.check_seconds/self.checks if self.checks else 0.,
+                 'max_check_seconds': self.max_check_seconds }
     def start(self):
-        super(ConditionPoller,self).start()
+        if self._scheduler:
+            self._scheduler.add(self)
+        else:
+            super(ConditionPoller,self).start()
+    def join(self, timeout=None):
+        if self._scheduler:
+            self._finished.wait(timeout)
+        else:
+            super(ConditionPoller,self).join(timeout)
+
+class PollScheduler(Thread):
+    """
+    run any number of ConditionPollers in one thread instead of one thread each
+
+        scheduler = PollScheduler()
+        for directory in directories:
+            DirectoryPoller(directory, '*.DAT', callback, scheduler=scheduler).start()
+
+    pollers are kept in a heap ordered by time of next check, and each is checked every polling_interval as before.
+    pollers that wait for events (DirectoryPoller with inotify) are also checked as soon as their file descriptor is readable.
+    with threads>1, checks run in a pool of worker threads so a slow condition does not delay other pollers,
+    and each poller is only checked by one worker at a time.
+    the scheduler thread starts when the first poller is added, and stops after shutdown().
+    """
+    def __init__(self, threads=1):
+        """
+        @param threads: number of threads running checks, 1 to run them in the scheduler thread itself
+        """
+        super(PollScheduler,self).__init__(name='poll-scheduler')
+        self.daemon = True
+        self._lock = Lock()
+        self._heap = [] # (time of next check, sequence, poller)
+        self._sequence = itertools.count()
+        self._fds = {} # file descriptor -> poller
+        self._checking = set() # pollers being checked now
+        self._removed = [] # pollers shut down but not yet finished
+        self._started = False
+        self._stopping = False
+        self._wake_read, self._wake_write = os.pipe()
+        fcntl.fcntl(self._wake_write, fcntl.F_SETFL, fcntl.fcntl(self._wake_write, fcntl.F_GETFL)|os.O_NONBLOCK)
+        self._work = Queue() if threads>1 else None
+        self._workers = [ Thread(target=self._work_loop, name='poll-worker') for n in xrange(threads) ] if threads>1 else []
+        for worker in self._workers:
+            worker.daemon = True
+
+    def add(self, poller):
+        """ start checking poller, called by poller.start() """
+        with self._lock:
+            if self._stopping:
+                raise ValueError('poll scheduler was shut down')
+            heapq.heappush(self._heap, (time.time(), self._sequence.next(), poller))
+            fd = poller._fileno()
+            if fd is not None:
+                self._fds[fd] = poller
+            start = not self._started
+            self._started = True
+        if start:
+            self.start()
+            for worker in self._workers:
+                worker.start()
+        self._wake()
+
+    def remove(self, poller):
+        """ stop checking poller, called by poller.shutdown() """
+        with self._lock:
+            self._removed.append(poller)
+        self._wake()
+
+    def shutdown(self):
+        """ shut down all pollers, then stop the scheduler thread and worker threads once checks running now are done
+            and close the wake-up pipe.  use join() to wait until it has stopped.
+        """
+        with self._lock:
+            if self._stopping:
+                return
+            self._stopping = True
+            started = self._started
+            pollers = set([ poller for when,sequence,poller in self._heap ] + self._fds.values()) | self._checking
+        for poller in pollers:
+            poller.shutdown()
+        if started:
+            self._wake()
+        else:
+            self._close()
+
+    def _close(self):
+        with self._lock:
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            self._wake_read = self._wake_write = None
+
+    def _wake(self):
+        with self._lock: # not after pipe is closed, its file descriptor number may be reused
+            if self._wake_write is None:
+                return
+            try:
+                os.write(self._wake_write, 'x')
+            except OSError as e:
+                if e.errno!=errno.EAGAIN: # pipe full: scheduler is already being woken
+                    raise
+
+    def run(self):
+        while True:
+            try:
+                self._run_once()
+            except:
+                log.error('poll scheduler failed', exc_info=True)
+            with self._lock:
+                if self._stopping and not self._checking:
+                    break
+        for worker in self._workers:
+            self._work.put(None)
+        for worker in self._workers:
+            worker.join()
+        with self._lock:
+            self._finish_removed()
+        self._close()
+
+    def _run_once(self):
+        with self._lock:
+            self._finish_removed()
+            timeout = max(0, self._heap[0][0]-time.time()) if self._heap else None
+            fds = [ fd for fd,poller in self._fds.iteritems() if poller not in self._checking and not poller._paused ]
+        readable = select.select([self._wake_read]+fds, [], [], timeout)[0]
+        if self._wake_read in readable:
+            os.read(self._wake_read, 4096)
+        due = []
+        with self._lock:
+            now = time.time()
+            while self._heap and self._heap[0][0]<=now:
+                due.append((heapq.heappop(self._heap)[2], True))
+            due += [ (self._fds[fd], False) for fd in readable if fd in self._fds ]
+            work = []
+            for poller,scheduled in due:
+                if poller._shutdown_now.is_set():
+                    continue
+                if poller in self._checking:
+                    if scheduled: # still being checked from an event: try again after interval
+                        heapq.heappush(self._heap, (now+poller.polling_interval, self._sequence.next(), poller))
+                    continue
+                self._checking.add(poller)
+                work.append((poller, scheduled))
+        for poller,scheduled in work:
+            if self._work:
+                self._work.put((poller, scheduled))
+            else:
+                self._check(poller, scheduled)
+
+    def _check(self, poller, scheduled):
+        """ @param scheduled: True if check was due by time (schedule the next one), False if woken by an event """
+        try:
+            poller._check_condition()
+        except:
+            log.error('poller check failed', exc_info=True)
+        with self._lock:
+            self._checking.discard(poller)
+            if scheduled and not poller._shutdown_now.is_set():
+                heapq.heappush(self._heap, (time.time()+poller.polling_interval, self._sequence.next(), poller))
+
+    def _work_loop(self):
+        while True:
+            item = self._work.get()
+            if item is None: # scheduler is stopping
+                return
+            poller,scheduled = item
+            self._check(poller, scheduled)
+            self._wake() # scheduler can watch file descriptor of poller again
+
+    def _finish_removed(self):
+        """ always called while holding lock, in scheduler thread so file descriptors are not closed while in select """
+        waiting = []
+        for poller in self._removed:
+            if poller in self._checking:
+                waiting.append(poller)
+            elif not poller._finished.is_set():
+                for fd,other in self._fds.items():
+                    if other is poller:
+                        del self._fds[fd]
+                try:
+                    poller._on_stopped()
+                except:
+                    log.error('failed to stop poller', exc_info=True)
+                poller._finished.set()
+        self._removed = waiting
+
+class _Inotify(object):
+    """ minimal ctypes wrapper for linux inotify watching one directory """
+    def __init__(self, directory, mask):
+        self.fd = _libc.inotify_init1(_IN_NONBLOCK|_IN_CLOEXEC)
+        if self.fd<0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        if _libc.inotify_add_watch(self.fd, directory, mask|IN_ONLYDIR)<0:
+            code = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(code, os.strerror(code), directory)
+    def wait(self, timeout):
+        """ @return: True if events can be read within timeout seconds """
+        return bool(select.select([self.fd], [], [], timeout)[0])
+    def read(self):
+        """ @return: list of (mask, name) for events ready now, without blocking """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno==errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset<len(data):
+            wd,mask,cookie,length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            events.append((mask, data[offset:offset+length].rstrip('\0')))
+            offset += length
+        return events
+    def close(self):
+        os.close(self.fd)
+
 class DirectoryPoller(ConditionPoller):
     """
     poll for new files added to a directory that match a wildcard pattern.
-    expects files to be added only, and added in ASCII order.
+    each check reports files added since the last check, in ASCII order, including files named out of sequence.
+
+    with inotify (linux only), files are reported as soon as they are closed after writing or renamed into the directory,
+    and files are reported in the order they were completed.
+
+    with capacity, checks are paused while the consumer cannot take more files, and files beyond what it can take
+    are held back for later checks (without inotify, they are simply found again by the next scan).
+
+    by default files are reported as soon as they are found, even if they are still being written.
+    to report files only once they are complete, pass a readiness policy: StableFile, MarkerFile or ClosedFile.
     """
-    def __init__(self, directory, wildcard, callback, exception_callback=None, interval=1):
+    def __init__(self, directory, wildcard, callback, exception_callback=None, interval=1, inotify=True, scheduler=None,
+                 min_interval=None, max_interval=None, capacity=None, ready=None):
+        """
+        @param interval: seconds between checks of the directory (with inotify: longest time to notice shutdown)
+        @param inotify: use inotify if available, otherwise check the whole directory every interval
+        @param scheduler: run checks in this PollScheduler instead of a new thread
+        @param min_interval: with max_interval, adapt interval to how often files arrive (see ConditionPoller)
+        @param max_interval: see min_interval
+        @param capacity: function returning how many more files callback can take now, 0 pauses checks (default unlimited)
+        @param ready: readiness policy that holds back files until they are complete
+        """
         try:
             if not os.path.isdir(directory):
                 raise ValueError('%s is not a directory'%directory)
-            self._path = directory + '/' + wildcard
+            self._directory = directory
+            self._wildcard = wildcard
+            self._match = re.compile(fnmatch.translate(wildcard)).match
+            self._hidden = wildcard.startswith('.') # like glob, * does not match names starting with .
             self._last_filename = None
-            super(DirectoryPoller,self).__init__(self._check_for_files, callback, exception_callback, interval)
+            self._known = set() # matching names found by last scan, only the most recent ones (see _scan)
+            self._low = None # names sorting before this are not reported
+            self._mtime = None
+            self._scan_time = None
+            self._capacity = capacity
+            self._ready = ready
+            self._pending = deque() # files found and ready, but held back until consumer can take them
+            self._inotify = None
+            if inotify and _libc:
+                try:
+                    self._inotify = _Inotify(directory, IN_CLOSE_WRITE|IN_MOVED_TO)
+                    self._reported = set() # recent files, so a file closed after writing again is not reported twice
+                    self._reported_order = deque()
+                except OSError:
+                    log.warning('inotify failed, polling %s instead', directory, exc_info=True)
+            condition = self._check_for_events if self._inotify else self._check_for_files
+            super(DirectoryPoller,self).__init__(condition, callback, exception_callback, interval, scheduler, min_interval, max_interval)
         except:
             log.error('failed init?', exc_info=True)
+    def _fileno(self):
+        return self._inotify.fd if self._inotify else None
+    def _on_stopped(self):
+        if self._inotify:
+            self._inotify.close()
+    def _wait(self):
+        if self._inotify and not self._paused:
+            self._inotify.wait(self.polling_interval)
+        else:
+            super(DirectoryPoller,self)._wait()
+    def _room(self):
+        """ @return: number of files the consumer can take now, or None if unlimited """
+        room = None if self._capacity is None else max(0, self._capacity())
+        self._paused = room==0
+        return room
+    def _check_for_events(self):
+        return self._check(self._read_events)
     def _check_for_files(self):
-        filenames = glob.glob(self._path)
-        # files, but no change since last time
-        if self._last_filename and filenames and filenames[-1]==self._last_filename:
+        """ report matching files not found by the last scan, in ASCII order
+
+            the directory is only listed if its mtime changed since the last scan.
+            files are compared with the set found by the last scan, so files added out of order are still reported,
+            and removed files are forgotten (a file removed and added again is reported again).
+            to keep memory bounded in very large directories, only the last 10000 names (in ASCII order) are kept:
+            a file added out of order is reported only if its name sorts after the oldest of these.
+        """
+        return self._check(self._scan)
+    def _check(self, find):
+        """ @param find: function(room) returning (files found by listing directory, files found by inotify close or rename) """
+        room = self._room()
+        if room==0:
             return None
-        # no files yet, just like last time
-        if not self._last_filename and not filenames:
+        if not self._pending:
+            scanned, closed = find(room)
+            self._pending.extend(self._ready.check(scanned, closed) if self._ready else scanned+closed)
+        out = [ self._pending.popleft() for n in xrange(len(self._pending) if room is None else min(room, len(self._pending))) ]
+        if not out:
             return None
-        if self._last_filename:
-            position = filenames.index(self._last_filename) # raises ValueError if file was removed
-            out = filenames[position+1:]
-        else:
-            out = filenames
-        self._last_filename = filenames[-1]
         log.trace('found files: %r', out)
         return out
+    def _read_events(self, room):
+        if self._last_filename is None:
+            # first check: report files already there (watch was added first, so none are missed in between)
+            scanned = self._list_files()
+            self._last_filename = scanned[-1] if scanned else ''
+            return [ filename for filename in scanned if self._remember(filename) ], []
+        scanned, closed = [], []
+        for mask,name in self._inotify.read():
+            if mask&IN_IGNORED:
+                raise IOError('directory %s was removed' % self._directory)
+            if mask&IN_Q_OVERFLOW:
+                log.warning('inotify events lost for %s, checking directory', self._directory)
+                scanned += [ filename for filename in self._list_files() if filename>self._last_filename and self._remember(filename) ]
+            elif fnmatch.fnmatch(name, self._wildcard) and self._remember(self._directory + '/' + name):
+                closed.append(self._directory + '/' + name)
+        if scanned or closed:
+            self._last_filename = max([self._last_filename] + scanned + closed)
+        return scanned, closed
+    def _remember(self, filename, limit=10000):
+        """ @return: True if filename was not reported recently """
+        if filename in self._reported:
+            return False
+        self._reported.add(filename)
+        self._reported_order.append(filename)
+        if len(self._reported_order)>limit:
+            self._reported.discard(self._reported_order.popleft())
+        return True
+    def _matching_names(self, low=None):
+        """ @param low: only names sorting at or after this """
+        return set([ name for name in _list_names(self._directory)
+                     if (low is None or name>=low) and self._match(name) and (self._hidden or not name.startswith('.')) ])
+    def _list_files(self):
+        return [ self._directory + '/' + name for name in sorted(self._matching_names()) ]
+    def _scan(self, room, limit=10000):
+        """ @param limit: most names to remember between scans (unless files are held back for the consumer) """
+        now = time.time()
+        mtime = os.stat(self._directory).st_mtime
+        if mtime==self._mtime and self._scan_time-mtime>_MTIME_MARGIN:
+            return [], []
+        self._mtime, self._scan_time = mtime, now
+        names = self._matching_names(self._low)
+        new = sorted(names - self._known)
+        if room is not None and len(new)>room:
+            # consumer cannot take them all: leave the rest to be found by the next scan
+            names -= set(new[room:])
+            new = new[:room]
+            self._mtime = None
+        elif len(names)>limit:
+            # forget the oldest names: high-water mark plus a window of recent names to catch files added out of order
+            names = set(heapq.nlargest(limit, names))
+            self._low = min(names)
+        self._known = names
+        return [ self._directory + '/' + name for name in new ], []
+
+class StableFile(object):
+    """ DirectoryPoller readiness policy: report a file when its size and mtime are the same for several checks in a row """
+    def __init__(self, checks=2):
+        """
+        @param checks: number of checks that must see the same size and mtime, 2 means unchanged for one interval
+        """
+        self.checks = checks
+        self._waiting = {} # filename -> ((size, mtime), number of checks seen unchanged)
+    def check(self, filenames, closed=()):
+        """ called by DirectoryPoller on every check
+            @param filenames: files found since last check
+            @param closed: files found since last check that inotify reported closed after writing
+            @return: files now ready, from these or earlier checks
+        """
+        for filename in list(filenames)+list(closed):
+            self._waiting[filename] = None
+        out = []
+        for filename,last in self._waiting.items():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                del self._waiting[filename] # removed before it was complete
+                continue
+            key = (stat.st_size, stat.st_mtime)
+            count = last[1]+1 if last and last[0]==key else 1
+            if count>=self.checks:
+                out.append(filename)
+                del self._waiting[filename]
+            else:
+                self._waiting[filename] = (key, count)
+        return sorted(out)
+
+class MarkerFile(object):
+    """ DirectoryPoller readiness policy: report a file when the producer has created a marker file next to it,
+        ie- data.DAT when data.DAT.done exists.  marker files are never reported themselves.
+    """
+    def __init__(self, suffix='.done'):
+        self.suffix = suffix
+        self._waiting = set()
+    def check(self, filenames, closed=()):
+        """ see StableFile.check """
+        self._waiting.update([ filename for filename in list(filenames)+list(closed) if not filename.endswith(self.suffix) ])
+        out = []
+        for filename in list(self._waiting):
+            if os.path.exists(filename + self.suffix):
+                out.append(filename)
+                self._waiting.discard(filename)
+            elif not os.path.exists(filename):
+                self._waiting.discard(filename)
+        return sorted(out)
+
+class ClosedFile(object):
+    """ DirectoryPoller readiness policy: report files as soon as inotify reports they were closed after writing
+        (or renamed into the directory).  files found by listing the directory (when the poller starts,
+        if inotify events were lost, or where inotify is not available) are reported when stable as in StableFile.
+    """
+    def __init__(self, checks=2):
+        self._stable = StableFile(checks)
+    def check(self, filenames, closed=()):
+        """ see StableFile.check """
+        return sorted(self._stable.check(filenames) + list(closed))
+
+_CANCELLED = object() # queued by BlockingDirectoryIterator.cancel()
 
 class BlockingDirectoryIterator(object):
     """
@@ -80,12 +570,26 @@ class BlockingDirectoryIterator(object):
     use like this:
         for filename in PollingDirectoryIterator('/tmp','A*.DAT').get_files():
             print filename
+    or to handle files in groups, for example to commit once for each group:
+        for filenames in PollingDirectoryIterator('/tmp','A*.DAT').get_batches(max_size=100, max_wait=1):
+            ...
+
+    with max_queued, polling is paused while that many files are waiting for the consumer,
+    and resumes at the next check after the consumer has taken some.
     """
-    def __init__(self, directory, wildcard, interval=1):
+    def __init__(self, directory, wildcard, interval=1, inotify=True, scheduler=None, min_interval=None, max_interval=None,
+                 max_queued=None, ready=None):
+        """
+        @param max_queued: most files found but not yet taken by the consumer (default unlimited)
+        @param ready: readiness policy (see DirectoryPoller)
+        """
         self._values = Queue()
         self._exception = None
         self._ready = Event()
-        self._poller = DirectoryPoller(directory, wildcard, self._on_condition, self._on_exception, interval)
+        self.max_queued = max_queued
+        capacity = self._capacity if max_queued else None
+        self._poller = DirectoryPoller(directory, wildcard, self._on_condition, self._on_exception, interval, inotify, scheduler,
+                                       min_interval, max_interval, capacity, ready)
         self._poller.start()
     def __iter__(self):
         return self
@@ -93,12 +597,44 @@ class BlockingDirectoryIterator(object):
         while True:
             # could have exception or list of filenames
             out = self._values.get()
+            if out is _CANCELLED:
+                self._values.put(out) # for any other consumers
+                return
             if isinstance(out, Exception):
                 raise out
             else:
                 yield out
+    def get_batches(self, max_size=100, max_wait=1.):
+        """ yield lists of up to max_size files: wait for the first file, then up to max_wait seconds for more """
+        while True:
+            batch = []
+            out = self._values.get()
+            deadline = time.time() + max_wait
+            while True:
+                if out is _CANCELLED:
+                    self._values.put(out)
+                    if batch:
+                        yield batch
+                    return
+                if isinstance(out, Exception):
+                    if batch:
+                        yield batch
+                    raise out
+                batch.append(out)
+                if len(batch)>=max_size:
+                    break
+                remaining = deadline - time.time()
+                try:
+                    out = self._values.get(timeout=remaining) if remaining>0 else self._values.get_nowait()
+                except Empty:
+                    break
+            yield batch
+    def _capacity(self):
+        return self.max_queued - self._values.qsize()
     def cancel(self):
+        """ stop polling, get_files() and get_batches() end after files already found """
         self._poller.shutdown()
+        self._values.put(_CANCELLED)
     def _on_condition(self, filenames):
         for file in filenames:
             self._values.put(file)
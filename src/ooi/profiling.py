@@ -0,0 +1,168 @@
+"""
+profile a code path only after it has been slow
+
+    profiler = AutoProfiler('/var/log/profiles', thresholds={ 'persist': 0.5 }, executions=20)
+    ...
+    t = Timer()
+    with profiler.profile('persist'):
+        persist(record)
+    t.complete_step('persist')
+    profiler.check(t)
+
+check() compares each step of the timer with its threshold (in seconds, or a percentile of an Accumulator).
+when a step is over its threshold, the next executions of profile() with the same label run under cProfile,
+and the combined profile is written to a file that can be read with pstats or tools like snakeviz:
+    /var/log/profiles/persist-20130611-093015-PID.prof
+
+rate limits keep profiling from taking over the process: at most one session per label every min_interval seconds,
+and at most max_sessions in total.  when a label is not being profiled, profile() costs one dictionary lookup.
+"""
+
+import os
+import time
+import cProfile
+import pstats
+import functools
+from threading import Lock
+from ooi.logging import log
+
+class _NotProfiled(object):
+    """ context manager returned by profile() when the label is not being profiled """
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NOT_PROFILED = _NotProfiled()
+
+class _Profiled(object):
+    """ context manager that runs the with block under cProfile """
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.label = label
+        self.profile = cProfile.Profile()
+    def __enter__(self):
+        self.profile.enable()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        self.profiler._add_profile(self.label, self.profile)
+
+class _Session(object):
+    """ profiles collected for one label after it went over threshold """
+    def __init__(self, executions):
+        self.remaining = executions # number of executions still to start
+        self.running = 0
+        self.stats = None
+
+class AutoProfiler(object):
+    def __init__(self, directory, thresholds=None, accumulator=None, percentile=None, executions=10,
+                 min_interval=600, max_sessions=20, refresh_seconds=10):
+        """
+        @param directory: write profiles to files in this directory
+        @param thresholds: dict of step label -> seconds, a step longer than this starts profiling
+        @param accumulator: with percentile, steps slower than this percentile of the same label in accumulator start profiling
+        @param percentile: see accumulator (ignored for labels in thresholds)
+        @param executions: number of executions of the code path to profile after a slow step
+        @param min_interval: seconds before the same label can be profiled again
+        @param max_sessions: maximum number of profiles written by this profiler
+        @param refresh_seconds: how often to get percentile values from accumulator
+        """
+        if not os.path.isdir(directory):
+            raise ValueError('%s is not a directory'%directory)
+        self.directory = directory
+        self.thresholds = thresholds or {}
+        self.accumulator = accumulator
+        self.percentile = percentile
+        self.executions = executions
+        self.min_interval = min_interval
+        self.max_sessions = max_sessions
+        self.refresh_seconds = refresh_seconds
+        self.lock = Lock()
+        self.files = [] # profiles written so far
+        self._sessions = {} # label -> _Session while being profiled
+        self._last_session = {} # label -> time last session started
+        self._session_count = 0
+        self._percentiles = {}
+        self._percentiles_time = 0
+
+    def profile(self, label):
+        """ @return: context manager that profiles the with block if a recent step labelled label was slow """
+        if label not in self._sessions:
+            return _NOT_PROFILED
+        with self.lock:
+            session = self._sessions.get(label)
+            if not session or not session.remaining:
+                return _NOT_PROFILED
+            session.remaining -= 1
+            session.running += 1
+        return _Profiled(self, label)
+
+    def profiled(self, label=None):
+        """ decorator to profile calls to the function with profile(label), default label is function name """
+        def decorator(function):
+            name = label or function.__name__
+            @functools.wraps(function)
+            def wrapper(*a, **b):
+                with self.profile(name):
+                    return function(*a, **b)
+            return wrapper
+        return decorator
+
+    def check(self, timer):
+        """ start profiling labels of any steps of the timer that went over threshold """
+        for label,elapsed in timer.get_steps():
+            if label and label not in self._sessions:
+                threshold = self._get_threshold(label)
+                if threshold is not None and elapsed>threshold:
+                    self.start(label)
+
+    def start(self, label):
+        """ profile the next executions of label, unless rate limits prevent it
+            @return: True if profiling was started
+        """
+        now = time.time()
+        with self.lock:
+            if label in self._sessions or self._session_count>=self.max_sessions:
+                return False
+            if now-self._last_session.get(label, 0)<self.min_interval:
+                return False
+            self._sessions[label] = _Session(self.executions)
+            self._last_session[label] = now
+            self._session_count += 1
+        log.info('step %s was slow, profiling next %d executions', label, self.executions)
+        return True
+
+    def _get_threshold(self, label):
+        if label in self.thresholds:
+            return self.thresholds[label]
+        if not self.accumulator or not self.percentile:
+            return None
+        now = time.time()
+        if now-self._percentiles_time>self.refresh_seconds:
+            self._percentiles = dict([ (key, self.accumulator.get_percentile(key, self.percentile)) for key in self.accumulator.keys() ])
+            self._percentiles_time = now
+        value = self._percentiles.get(label)
+        return None if value is None or value!=value else value # skip nan: no values yet
+
+    def _add_profile(self, label, profile):
+        with self.lock:
+            session = self._sessions[label]
+            if session.stats:
+                session.stats.add(profile)
+            else:
+                session.stats = pstats.Stats(profile)
+            session.running -= 1
+            if session.remaining or session.running:
+                return
+            del self._sessions[label]
+        self._write(label, session.stats)
+
+    def _write(self, label, stats):
+        filename = os.path.join(self.directory, '%s-%s-%d.prof' % (label, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        try:
+            stats.dump_stats(filename)
+            self.files.append(filename)
+            log.info('wrote profile of step %s: %s', label, filename)
+        except:
+            log.error('failed to write profile %s', filename, exc_info=True)
@@ -0,0 +1,255 @@
+"""
+combine Accumulator stats from several processes on the same node through a memory-mapped file
+
+each worker process writes its own values:
+    stats = SharedAccumulator('/dev/shm/ingest.stats')
+    ...
+    t = Timer()
+    ...
+    stats.add(t)
+
+and any process can read a node-level view of all workers, as an ordinary Accumulator:
+    a = aggregate('/dev/shm/ingest.stats')
+    print a.get_percentile('persist', 99)
+
+the file is divided into one slot per process.  a process claims a free slot when it first opens the file
+(the only time the file is locked), then writes count, mean, variance, min, max and histogram buckets
+for each label directly into its slot.  there are no locks between processes: a sequence number in each slot
+is incremented before and after every update, and readers copy the slot again if it changed while they read it.
+threads in one process share its slot and take a lock within the process.
+
+a slot keeps the stats of a process after it exits, until a new process finds no unused slot and claims it.
+each slot holds a fixed number of labels; when they are all used, values of new labels are added to '__other__'.
+"""
+
+import os
+import errno
+import mmap
+import struct
+import fcntl
+from threading import Lock
+from ooi.timer import Accumulator, _Histogram, _combine
+
+_MAGIC = b'OOIS'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIIIIiii') # magic, version, processes, labels, label_size, precision, min_exponent, max_exponent
+_HEADER_SIZE = 64
+_SLOT_HEADER = struct.Struct('<qQ') # pid, sequence (odd while being updated)
+_STATS = struct.Struct('<qdddd') # count, mean, m2, min, max
+_BUCKET = struct.Struct('<q')
+_OTHER = '__other__'
+
+class _Layout(object):
+    """ offsets of everything in the file """
+    def __init__(self, processes, labels, label_size, precision, min_exponent, max_exponent):
+        if label_size%8:
+            raise ValueError('label_size must be a multiple of 8')
+        self.processes = processes
+        self.labels = labels
+        self.label_size = label_size
+        self.histogram = _Histogram(precision, min_exponent, max_exponent)
+        self.half = (max_exponent-min_exponent+1)*self.histogram.sub_buckets + 1 # buckets for zero and positive values
+        self.buckets = 2*self.half - 1
+        self.label_block = _STATS.size + self.buckets*_BUCKET.size
+        self.names_offset = _SLOT_HEADER.size
+        self.stats_offset = self.names_offset + labels*label_size
+        self.slot_size = self.stats_offset + labels*self.label_block
+        self.size = _HEADER_SIZE + processes*self.slot_size
+
+    def pack(self):
+        h = self.histogram
+        return _HEADER.pack(_MAGIC, _VERSION, self.processes, self.labels, self.label_size, h.precision, h.min_exponent, h.max_exponent)
+
+    @classmethod
+    def unpack(cls, data, filename):
+        magic,version,processes,labels,label_size,precision,min_exponent,max_exponent = _HEADER.unpack_from(data, 0)
+        if magic!=_MAGIC or version!=_VERSION:
+            raise ValueError('%s is not a shared stats file' % filename)
+        return cls(processes, labels, label_size, precision, min_exponent, max_exponent)
+
+    def slot(self, index):
+        return _HEADER_SIZE + index*self.slot_size
+
+    def new_histogram(self):
+        h = self.histogram
+        return _Histogram(h.precision, h.min_exponent, h.max_exponent)
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno==errno.EPERM # exists, owned by another user
+    return True
+
+class SharedAccumulator(object):
+    """ write stats of this process into its own slot of a shared stats file, see module docs """
+    def __init__(self, filename, processes=64, labels=32, label_size=64, precision=3, min_exponent=-20, max_exponent=12):
+        """
+        layout arguments are only used if the file does not exist yet, otherwise the layout of the file is used
+
+        @param filename: shared file, preferably on a memory filesystem such as /dev/shm
+        @param processes: number of process slots
+        @param labels: number of labels in each slot (including __other__)
+        @param label_size: bytes used for each label name, longer names are truncated
+        @param precision: bits of linear sub-buckets in histogram, as in Accumulator but smaller by default to save space
+        @param min_exponent: smallest power of two in histogram (default 2**-20, about 1 microsecond)
+        @param max_exponent: largest power of two in histogram (default 2**12, about 1 hour in seconds)
+        """
+        self.filename = filename
+        self.lock = Lock()
+        fd = os.open(filename, os.O_RDWR|os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size==0:
+                    self.layout = _Layout(processes, labels, label_size, precision, min_exponent, max_exponent)
+                    os.ftruncate(fd, self.layout.size)
+                    os.write(fd, self.layout.pack())
+                else:
+                    self.layout = _Layout.unpack(os.read(fd, _HEADER.size), filename)
+                self.map = mmap.mmap(fd, self.layout.size)
+                self._claim_slot()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd) # mmap keeps its own reference to the file
+
+    def _claim_slot(self):
+        """ called while holding file lock: use an unused slot, or else the slot of a process that has exited """
+        layout = self.layout
+        pids = [ _SLOT_HEADER.unpack_from(self.map, layout.slot(index))[0] for index in xrange(layout.processes) ]
+        if 0 in pids:
+            index = pids.index(0)
+        else:
+            exited = [ index for index,pid in enumerate(pids) if not _is_running(pid) ]
+            if not exited:
+                raise ValueError('no free process slot in %s' % self.filename)
+            index = exited[0]
+        offset = layout.slot(index)
+        self.map[offset:offset+layout.slot_size] = b'\0'*layout.slot_size
+        self.pid = os.getpid()
+        _SLOT_HEADER.pack_into(self.map, offset, self.pid, 0)
+        self._offset = offset
+        self._sequence = 0
+        self._labels = {} # label -> index within slot
+
+    def _reclaim_after_fork(self):
+        fd = os.open(self.filename, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                self._claim_slot()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def add(self, timer, weight=1):
+        """ add steps of timer, as Accumulator.add """
+        values = [ (label or str(index), delta) for index,(label,delta) in enumerate(timer.get_steps()) ]
+        values.append(('__total__', timer._elapsed()))
+        values.extend(timer.get_resource_steps())
+        self._add(values, weight)
+
+    def add_value(self, label, value, weight=1):
+        self._add([(label, value)], weight)
+
+    def _add(self, values, weight):
+        with self.lock:
+            if os.getpid()!=self.pid:
+                self._reclaim_after_fork() # child process must not write into parent's slot
+            self._sequence += 1
+            _SLOT_HEADER.pack_into(self.map, self._offset, self.pid, self._sequence)
+            try:
+                for label,value in values:
+                    self._record(self._label_index(label), value, weight)
+            finally:
+                self._sequence += 1
+                _SLOT_HEADER.pack_into(self.map, self._offset, self.pid, self._sequence)
+
+    def _label_index(self, label):
+        index = self._labels.get(label)
+        if index is None:
+            layout = self.layout
+            if len(self._labels)<layout.labels-1 or (label==_OTHER and len(self._labels)<layout.labels):
+                index = len(self._labels)
+            else:
+                return self._label_index(_OTHER)
+            name = label[:layout.label_size]
+            offset = self._offset + layout.names_offset + index*layout.label_size
+            self.map[offset:offset+len(name)] = name
+            self._labels[label] = index
+        return index
+
+    def _record(self, index, value, weight):
+        layout = self.layout
+        offset = self._offset + layout.stats_offset + index*layout.label_block
+        count,mean,m2,min_value,max_value = _STATS.unpack_from(self.map, offset)
+        if count:
+            count,mean,m2 = _combine(count, mean, m2, weight, value, 0.)
+            _STATS.pack_into(self.map, offset, count, mean, m2, min(min_value, value), max(max_value, value))
+        else:
+            _STATS.pack_into(self.map, offset, weight, value, 0., value, value)
+        bucket = offset + _STATS.size + (layout.histogram._index(value)+layout.half-1)*_BUCKET.size
+        _BUCKET.pack_into(self.map, bucket, _BUCKET.unpack_from(self.map, bucket)[0] + weight)
+
+    def close(self):
+        """ stop writing: stats written so far stay in the file until another process claims the slot """
+        self.map.close()
+
+def _read_slot(data, offset, layout, retries=1000):
+    """ @return: (pid, copy of slot bytes) consistent with one sequence number """
+    for attempt in xrange(retries):
+        pid,before = _SLOT_HEADER.unpack_from(data, offset)
+        copy = data[offset:offset+layout.slot_size]
+        pid,after = _SLOT_HEADER.unpack_from(data, offset)
+        if before==after and not before%2:
+            return pid, copy
+    return pid, copy # writer stopped while updating, most likely exited: use what it wrote
+
+def read_entries(filename, live_only=False):
+    """ @return: list of (pid, label, count, mean, m2, min, max, histogram) for each process slot and label in the file
+        @param live_only: skip slots of processes that are no longer running
+    """
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        layout = _Layout.unpack(data, filename)
+        out = []
+        for index in xrange(layout.processes):
+            pid,slot = _read_slot(data, layout.slot(index), layout)
+            if pid==0 or (live_only and not _is_running(pid)):
+                continue
+            for label_index in xrange(layout.labels):
+                offset = layout.names_offset + label_index*layout.label_size
+                name = slot[offset:offset+layout.label_size].rstrip(b'\0')
+                if not name:
+                    break
+                offset = layout.stats_offset + label_index*layout.label_block
+                count,mean,m2,min_value,max_value = _STATS.unpack_from(slot, offset)
+                if not count:
+                    continue
+                histogram = layout.new_histogram()
+                buckets = struct.unpack_from('<%dq' % layout.buckets, slot, offset+_STATS.size)
+                for bucket,bucket_count in enumerate(buckets):
+                    if bucket_count:
+                        histogram.counts[bucket-layout.half+1] = bucket_count
+                        histogram.total += bucket_count
+                out.append((pid, name, count, mean, m2, min_value, max_value, histogram))
+        return out
+    finally:
+        data.close()
+
+def aggregate(filename, live_only=False, **kwargs):
+    """ @return: Accumulator with stats of all processes in the shared file
+        @param live_only: skip slots of processes that are no longer running
+        @param kwargs: other arguments to Accumulator(), name defaults to file name
+    """
+    kwargs.setdefault('name', os.path.basename(filename))
+    out = Accumulator(**kwargs)
+    entries = [ entry[1:] for entry in read_entries(filename, live_only) ]
+    if out.sharded:
+        out._get_shard().merge_entries(entries)
+    else:
+        out._writable_stats().merge_entries(entries)
+    return out
@@ -0,0 +1,172 @@
+"""
+time nested phases of an operation as a tree, and aggregate many trees into totals for each path
+
+    t = SpanTimer()
+    with t.span('dispatch'):
+        with t.span('decode'):
+            ...
+        with t.span('persist'):
+            ...
+    spans.add(t)    # spans = SpanAccumulator()
+
+then log or query totals and self-times (time not spent in any child span) for each path,
+or write them in folded-stack format, which flamegraph.pl (https://github.com/brendangregg/FlameGraph)
+turns into a flame graph:
+    spans.write_folded('/tmp/spans.folded')
+"""
+
+import logging
+from threading import Lock
+from ooi.timer import _SelfLogging, _clock, skip_calling_module
+
+skip_calling_module(globals()) # default name of SpanTimer and SpanAccumulator is the module that created them
+
+class _Span(object):
+    """ one timed scope, and the scopes nested within it """
+    __slots__ = [ 'name', 'start', 'elapsed', 'children' ]
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.elapsed = None
+        self.children = []
+
+    def get_self_time(self):
+        return self.elapsed - sum([ child.elapsed for child in self.children ])
+
+class _SpanScope(object):
+    """ context manager returned by SpanTimer.span() """
+    __slots__ = [ 'timer', 'name' ]
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+    def __enter__(self):
+        self.timer.start_span(self.name)
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.end_span()
+
+class SpanTimer(_SelfLogging):
+    """ record time taken by nested scopes of one operation (in one thread) """
+    def __init__(self, name=None, logger=None, level=logging.DEBUG, milliseconds=True, number_format='%f'):
+        """
+        @param name: override module name used for default logger with logging.getLogger('timing.'+name)
+        @param logger: override default logger with this
+        @param level: log times at this log level
+        @param milliseconds: report time in milliseconds (vs seconds)?
+        @param number_format: '%f' used by default
+        """
+        super(SpanTimer,self).__init__(name, logger, level, 'timing')
+        self.multiplier = 1000 if milliseconds else 1
+        self.number_format = number_format
+        self.roots = []
+        self._open = []
+
+    def span(self, name):
+        """ @return: context manager that times the with block as a span nested in the currently open span """
+        return _SpanScope(self, name)
+
+    def start_span(self, name):
+        span = _Span(name, _clock())
+        if self._open:
+            self._open[-1].children.append(span)
+        else:
+            self.roots.append(span)
+        self._open.append(span)
+
+    def end_span(self):
+        span = self._open.pop()
+        span.elapsed = _clock()-span.start
+
+    def __str__(self):
+        lines = []
+        def describe(span, depth):
+            elapsed = 'open' if span.elapsed is None else self.number_format%(self.multiplier*span.elapsed)
+            lines.append('  '*depth + span.name + ': ' + elapsed)
+            for child in span.children:
+                describe(child, depth+1)
+        for root in self.roots:
+            describe(root, 0)
+        return '\n'.join(lines)
+
+    def log(self):
+        self._log()
+
+class SpanAccumulator(_SelfLogging):
+    """ merge the span trees of many SpanTimers into count, total time and self time for each path
+
+        a path is the tuple of span names from the root, ie- ('dispatch','decode'),
+        or the same names joined with ';' as used by folded-stack output, ie- 'dispatch;decode'
+    """
+    def __init__(self, name=None, logger=None, level=logging.INFO, milliseconds=True, number_format='%f'):
+        """
+        @param name: override module name used for default logger with logging.getLogger('stats.'+name)
+        @param logger: override default logger with this
+        @param level: log times at this log level
+        @param milliseconds: report time in milliseconds (vs seconds)?
+        @param number_format: '%f' used by default
+        """
+        super(SpanAccumulator,self).__init__(name, logger, level, 'stats')
+        self.multiplier = 1000 if milliseconds else 1
+        self.format = '%d calls, ' + number_format + ' total, ' + number_format + ' self'
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self._paths = {} # path -> [ count, total time, self time ]
+
+    def add(self, timer):
+        """ add all completed spans of timer """
+        with self.lock:
+            for root in timer.roots:
+                self._add(root, ())
+
+    def _add(self, span, parent_path):
+        if span.elapsed is None:
+            return
+        path = parent_path + (span.name,)
+        totals = self._paths.get(path)
+        if totals is None:
+            totals = self._paths[path] = [ 0, 0., 0. ]
+        totals[0] += 1
+        totals[1] += span.elapsed
+        totals[2] += span.get_self_time()
+        for child in span.children:
+            self._add(child, path)
+
+    def paths(self):
+        return self._paths.keys()
+
+    def _get(self, path, index, default):
+        if isinstance(path, basestring):
+            path = tuple(path.split(';'))
+        totals = self._paths.get(path)
+        return totals[index] if totals else default
+
+    def get_count(self, path):
+        return self._get(path, 0, 0)
+    def get_total(self, path):
+        return self._get(path, 1, float('nan'))
+    def get_self_time(self, path):
+        return self._get(path, 2, float('nan'))
+
+    def folded(self, scale=1e6):
+        """ @return: folded-stack lines "root;child;grandchild SELF_TIME", self time in microseconds by default """
+        with self.lock:
+            items = sorted(self._paths.items())
+        return [ '%s %d' % (';'.join(path), int(round(totals[2]*scale))) for path,totals in items ]
+
+    def write_folded(self, filename, scale=1e6):
+        with open(filename, 'w') as f:
+            for line in self.folded(scale):
+                f.write(line + '\n')
+
+    def __str__(self):
+        with self.lock:
+            items = sorted(self._paths.items())
+        return '\n'.join([ '  '*(len(path)-1) + path[-1] + ': ' +
+                           self.format % (count, self.multiplier*total, self.multiplier*self_time)
+                           for path,(count,total,self_time) in items ])
+
+    def log(self):
+        self._log()
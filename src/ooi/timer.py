@@ -1,36 +1,128 @@
 """
 record time taken for code to perform several steps
 collect and report statistics for timing and other metrics
+measure rates of events with Meter
 
 NOTE: by default Timer and Accumulator will use special loggers.  for example, if you create a Timer
     in module foo/bar/baz.py:
         t = Timer()
         t.log()
+
+for steps that must not be affected by wall clock changes (NTP adjustments, etc), use MonotonicTimer.
+on python 2 it costs more per step than Timer, see its notes:
+        t = MonotonicTimer()
+        with t.step('decode'):
+            decode(message)
+        accumulator.add(t)
+or time whole function calls without creating a Timer at all:
+        @timed(accumulator, 'publish')
+        def publish(message): ...
 """
 
 import time
+import sys
+import functools
 import logging
-from threading import Lock
+import weakref
+from threading import Lock, RLock, local, Thread
+from Queue import Queue, Empty
+import itertools
+import heapq
 import math
-import inspect
+from array import array
 from ooi.logging import log
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import tracemalloc # python 3.4+
+except ImportError:
+    tracemalloc = None
+
+_calling_modules = {} # code object -> module name, so each call site is only resolved once
+_library_modules = set() # id() of globals of modules skipped when finding the calling module, see skip_calling_module
+
 def _get_calling_module(default_value=None):
+    """ find name of module that created the Timer or Accumulator by walking frames directly
+        (inspect.stack() would read source lines for every frame in the stack)
+    """
     try:
-        stack = inspect.stack()
-        # stack[0]: call to inspect.stack() on the line above
-        # stack[1]: call to _get_calling_module() below
-        # stack[2] # call to _SelfLogging.__init__() by subclass
-        frame=stack[3] # call to Timer() or Accumulator() by caller
-        if frame and frame[0]:
-            module = inspect.getmodule(frame[0])
-            if module:
-                return module.__name__
-            elif frame[1]:
-                return frame[1]
+        frame = sys._getframe(1)
+        # skip frames in this module and others built on it: _SelfLogging.__init__, Timer.__init__, SpanTimer.__init__, etc
+        while frame and id(frame.f_globals) in _library_modules:
+            frame = frame.f_back
+        if frame:
+            code = frame.f_code
+            name = _calling_modules.get(code)
+            if not name:
+                name = _calling_modules[code] = frame.f_globals.get('__name__') or code.co_filename
+            return name
     except:
         log.warning('failed to inspect calling module', exc_info=True)
-        return default_value
+    return default_value
+
+def skip_calling_module(module_globals):
+    """ when finding the module that created a Timer or Accumulator for its default name, skip frames in this module
+        @param module_globals: globals() of a module with subclasses of Timer, Accumulator, etc
+    """
+    _library_modules.add(id(module_globals))
+
+def _get_posix_clock(clock_id):
+    """ @return: function that returns seconds from clock_gettime(clock_id) (through ctypes, for python 2 on linux),
+                 or None if it is not available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        # PyDLL: keep the GIL during the call, clock_gettime is too quick to be worth releasing it
+        clock_gettime = ctypes.PyDLL(ctypes.util.find_library('c') or 'librt.so.1').clock_gettime
+        clock_gettime.restype = ctypes.c_int
+        # no argtypes: ctypes then converts each argument through them on every call, about 300ns more on python 2.7.
+        # arguments are already a python int (passed as c_int) and an array (passed as a pointer), which need no conversion.
+        timespec = ctypes.c_long*2 # tv_sec, tv_nsec
+        buffers = local() # one timespec per thread: reused by each call, but never overwritten by another thread's reading
+        def clock(clock_gettime=clock_gettime, clock_id=clock_id, buffers=buffers, timespec=timespec):
+            try:
+                value = buffers.value
+            except AttributeError:
+                value = buffers.value = timespec()
+            clock_gettime(clock_id, value)
+            seconds,nanoseconds = value[:]
+            return seconds + nanoseconds*1e-9
+        clock()
+        return clock
+    except:
+        log.warning('clock_gettime not available', exc_info=True)
+        return None
+
+def _get_monotonic_clock():
+    """ @return: function that returns seconds from a high-resolution clock unaffected by wall clock changes,
+                 or time.time if no monotonic clock is available
+    """
+    try:
+        return time.perf_counter # python 3.3+
+    except AttributeError:
+        pass
+    return _get_posix_clock(1) or time.time # CLOCK_MONOTONIC
+
+def _get_thread_cpu_clock():
+    """ @return: function that returns CPU seconds used by the current thread, or None if not available """
+    try:
+        return time.thread_time # python 3.7+
+    except AttributeError:
+        pass
+    return _get_posix_clock(3) # CLOCK_THREAD_CPUTIME_ID
+
+def _allocated_bytes():
+    return tracemalloc.get_traced_memory()[0]
+
+_clock = _get_monotonic_clock()
+_thread_cpu_clock = _get_thread_cpu_clock()
+skip_calling_module(globals())
 
 class _SelfLogging(object):
     """ base class provides shared logging behavior of Timer and Accumulator """
@@ -54,16 +146,28 @@ class _SelfLogging(object):
 
 
 class Timer(_SelfLogging):
-    def __init__(self, name=None, logger=None, level=logging.DEBUG, milliseconds=True, number_format='%f'):
+    """ record time of several steps of an operation
+
+        Timer(cpu=True) also records CPU time used by the current thread in each step,
+        so a slow step can be told apart as computing (cpu close to elapsed) or waiting for I/O, locks or the GIL.
+        Timer(memory=True) also records the change in memory allocated by python during each step
+        (python 3 only, and only while tracemalloc is tracing: see tracemalloc.start()).
+        Accumulator.add() records these as separate values labelled STEP.cpu and STEP.alloc
+    """
+    def __init__(self, name=None, logger=None, level=logging.DEBUG, milliseconds=True, number_format='%f', cpu=False, memory=False):
         """
         @param name: override module name used for default logger with logging.getLogger('timing.'+name)
         @param logger: override default logger with this
         @param level: log times at this log level
         @param milliseconds: report time in milliseconds (vs seconds)?
         @param number_format: '%f' used by default
+        @param cpu: also record thread CPU time used by each step
+        @param memory: also record change in bytes allocated (traced by tracemalloc) by each step
         """
         super(Timer, self).__init__(name, logger, level, 'timing')
 
+        self._resources = _get_resource_readers(cpu, memory)
+        self.resources = [] # tuple of readings for each of self.times
         self.times = [] # list of tuples (msg, time)
         self.complete_step("start")
         self.multiplier = 1000 if milliseconds else 1
@@ -72,28 +176,46 @@ class Timer(_SelfLogging):
 
     def complete_step(self, label=None):
         self.times.append((label, time.time()))
+        if self._resources:
+            self.resources.append([ read() for suffix,read in self._resources ])
+
+    def get_resource_steps(self):
+        """ @return: list of (STEP.cpu, seconds) and (STEP.alloc, bytes) for each completed step, and __total__.cpu, __total__.alloc
+                     (empty unless created with cpu=True or memory=True)
+        """
+        out = []
+        if len(self.resources)<2:
+            return out
+        labels = [ label or str(index) for index,(label,when) in enumerate(self.times[1:]) ] + [ '__total__' ]
+        readings = zip(self.resources[:-1], self.resources[1:]) + [ (self.resources[0], self.resources[-1]) ]
+        for label,(earlier,later) in zip(labels, readings):
+            for (suffix,read),before,after in zip(self._resources, earlier, later):
+                out.append((label + suffix, after-before))
+        return out
+
+    def get_steps(self):
+        """ @return: list of (label, seconds) for each completed step, label is None if complete_step() had none """
+        return [ (later[0], later[1]-earlier[1]) for earlier,later in zip(self.times[:-1], self.times[1:]) ]
 
     def __str__(self):
+        steps = self.get_steps()
         # special case if only have start time (complete_step never called)
-        if len(self.times)==1:
-            return 'start time: ' + self.times[0][1]
+        if not steps:
+            return 'start time: %f' % self.times[0][1]
 
         # otherwise message has format: elapsed TOTAL unit
-        message = 'elapsed' + self.lone_number_format%self.multiplier*self._elapsed() + ' s' if self.multiplier==1 else ' ms'
-        if len(self.times)==2:
+        message = 'elapsed' + self.lone_number_format%(self.multiplier*self._elapsed()) + (' s' if self.multiplier==1 else ' ms')
+        if len(steps)==1:
             return message
 
         # or: elapsed TOTAL unit: num1 num2 ...
         # or: elapsed TOTAL unit: step1=num1 step2=num2 ...
         message += ':'
-        for pair_o_tuples in zip(self.times[1:],self.times[:-1]):
-            # looping through adjacent pairs: [(labelN,timeN), (labelN+1,timeN+1)]
-            delta = self.multiplier*(pair_o_tuples[0][1]-pair_o_tuples[1][1])
-            label = pair_o_tuples[1][0]
+        for label,delta in steps:
             if label:
-                message += self.label_number_format%(label,delta)
+                message += self.label_number_format%(label,self.multiplier*delta)
             else:
-                message += self.lone_number_format%delta
+                message += self.lone_number_format%(self.multiplier*delta)
         return message
 
     def _elapsed(self):
@@ -105,6 +227,638 @@ class Timer(_SelfLogging):
         if min and self._elapsed()>=min:
             self._log()
 
+_resource_readers = {} # (cpu, memory, tracing) -> list of readers, shared by all Timers created with these arguments
+_resource_warnings = set() # warnings already logged, so a Timer created for every message does not log each time
+
+def _get_resource_readers(cpu, memory):
+    """ @return: list of (label suffix, function) for resources to measure with each Timer step (shared, not to be modified) """
+    tracing = bool(memory and tracemalloc and tracemalloc.is_tracing()) # tracing may be started or stopped at any time
+    key = (cpu, memory, tracing)
+    out = _resource_readers.get(key)
+    if out is None:
+        out = []
+        if cpu:
+            if _thread_cpu_clock:
+                out.append(('.cpu', _thread_cpu_clock))
+            else:
+                _warn_once('thread CPU time is not available, Timer will not record it')
+        if memory:
+            if tracing:
+                out.append(('.alloc', _allocated_bytes))
+            else:
+                _warn_once('tracemalloc is not tracing, Timer will not record memory allocated')
+        _resource_readers[key] = out
+    return out
+
+def _warn_once(message):
+    if message not in _resource_warnings:
+        _resource_warnings.add(message)
+        log.warning(message)
+
+class _TimedStep(object):
+    """ context manager returned by MonotonicTimer.step() """
+    __slots__ = [ 'timer', 'label', 'start' ]
+    def __init__(self, timer, label):
+        self.timer = timer
+        self.label = label
+    def __enter__(self):
+        self.start = _clock()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = _clock()
+        # record step directly in timer's storage (a method call would cost more than the rest of this)
+        timer = self.timer
+        count = timer._count
+        try:
+            timer._labels[count] = self.label
+        except IndexError:
+            timer._grow()
+            timer._labels[count] = self.label
+        timer._deltas[count] = end-self.start
+        timer._count = count+1
+        timer._last = end
+
+class MonotonicTimer(Timer):
+    """ Timer using a monotonic high-resolution clock (not affected by NTP or other clock changes)
+
+        step times are kept as durations in a preallocated array instead of a list of (label,time) tuples.
+        steps can be marked with complete_step() as with Timer, or by timing a block of code:
+            with timer.step('decode'):
+                ...
+        unlike complete_step(), time spent between with blocks is not part of any step (but is part of the total).
+
+        measured cost per step (test/ooi/benchmark_timer.py, best of several runs, CPython 2.7 on linux):
+            Timer.complete_step()                   ~330ns  (time.time, wall clock)
+            MonotonicTimer.complete_step()          ~950ns  (clock_gettime through ctypes costs ~500ns of this)
+            with MonotonicTimer.step(label)        ~2050ns  (two clock reads plus context manager calls)
+        on python 2 use it for correctness, not speed: each step costs about 3 times as much as with Timer
+        (6 times with step()), the price of a clock that does not jump.  what is saved is memory,
+        a few bytes per step instead of a (label,time) tuple.
+        on python 3 the clock is time.perf_counter, which costs about as much as time.time.
+    """
+    def __init__(self, name=None, logger=None, level=logging.DEBUG, milliseconds=True, number_format='%f', capacity=8):
+        """
+        @param capacity: number of steps to preallocate storage for (grows if more steps are recorded)
+        """
+        _SelfLogging.__init__(self, name, logger, level, 'timing')
+        self.multiplier = 1000 if milliseconds else 1
+        self.lone_number_format = ' '+number_format
+        self.label_number_format = ' %s='+number_format
+        self._labels = [None]*capacity
+        self._deltas = array('d', [0.])*capacity
+        self._count = 0
+        self._resources = ()
+        self.resources = []
+        self._start = self._last = _clock()
+
+    def complete_step(self, label=None):
+        now = _clock()
+        count = self._count
+        try:
+            self._labels[count] = label
+        except IndexError: # storage is full (cheaper than checking length every step)
+            self._grow()
+            self._labels[count] = label
+        self._deltas[count] = now-self._last
+        self._count = count+1
+        self._last = now
+
+    def step(self, label):
+        """ @return: context manager that records time spent in the with block as a step named label """
+        return _TimedStep(self, label)
+
+    def _grow(self):
+        """ double storage for steps (or make room for 8 if created with capacity=0) """
+        size = len(self._labels) or 8
+        self._labels.extend([None]*size)
+        self._deltas.extend(array('d', [0.])*size)
+
+    @property
+    def times(self):
+        """ (label,time) tuples like Timer, but times are from the monotonic clock, not time.time() """
+        out = [ ('start', self._start) ]
+        now = self._start
+        for label,delta in self.get_steps():
+            now += delta
+            out.append((label, now))
+        return out
+
+    def get_steps(self):
+        return zip(self._labels[:self._count], self._deltas[:self._count].tolist())
+
+    def _elapsed(self):
+        return self._last-self._start
+
+def timed(accumulator, label=None):
+    """ decorator to add time taken by each call of the function to accumulator, without creating a Timer
+        @param label: name of value added to accumulator, default is the function name
+    """
+    def decorator(function):
+        step = label or function.__name__
+        @functools.wraps(function)
+        def wrapper(*a, **b):
+            start = _clock()
+            try:
+                return function(*a, **b)
+            finally:
+                accumulator.add_value(step, _clock()-start)
+        return wrapper
+    return decorator
+
+class _Histogram(object):
+    """ fixed-memory log-bucketed histogram (HDR-style) used by Accumulator to report percentiles
+
+        each power of two is split into 2**precision linear sub-buckets, so a reported percentile is within
+        about 1/2**(precision+1) of a value actually recorded.  values outside 2**min_exponent..2**max_exponent
+        are clamped into the first or last bucket, so the number of buckets (and memory) never grows past a fixed limit.
+    """
+    __slots__ = [ 'precision', 'sub_buckets', 'min_exponent', 'max_exponent', 'counts', 'total' ] # one per label: no __dict__ saves ~1KB each
+    def __init__(self, precision=5, min_exponent=-30, max_exponent=34):
+        """
+        @param precision: number of bits used for linear sub-buckets within each power of two
+        @param min_exponent: smallest power of two tracked (default 2**-30, about 1 nanosecond)
+        @param max_exponent: largest power of two tracked (default 2**34, about 500 years in seconds)
+        """
+        self.precision = precision
+        self.sub_buckets = 1<<precision
+        self.min_exponent = min_exponent
+        self.max_exponent = max_exponent
+        self.counts = {} # sparse map of bucket index -> count, bounded by total number of buckets
+        self.total = 0
+
+    def add(self, value, count=1):
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+
+    def add_values(self, values):
+        if numpy is None:
+            for value in values:
+                self.add(value)
+            return
+        values = numpy.asarray(values, dtype=float)
+        mantissa,exponent = numpy.frexp(numpy.abs(values))
+        low = exponent<self.min_exponent
+        high = exponent>self.max_exponent
+        exponent = numpy.clip(exponent, self.min_exponent, self.max_exponent)
+        mantissa = numpy.where(low, 0.5, numpy.where(high, 0.99999999, mantissa))
+        index = (exponent-self.min_exponent)*self.sub_buckets + ((mantissa*2-1)*self.sub_buckets).astype(int) + 1
+        index = numpy.where(values==0, 0, numpy.where(values>0, index, -index))
+        indices,counts = numpy.unique(index, return_counts=True)
+        for index,count in zip(indices.tolist(), counts.tolist()):
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += len(values)
+
+    def merge(self, other):
+        if (other.precision,other.min_exponent,other.max_exponent)!=(self.precision,self.min_exponent,self.max_exponent):
+            # different bucket layout: re-bucket using representative value of each bucket in other
+            for index,count in other.counts.iteritems():
+                self.add(other._value(index), count)
+            return
+        for index,count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+
+    def snapshot(self):
+        return { 'precision': self.precision, 'min_exponent': self.min_exponent, 'max_exponent': self.max_exponent,
+                 'counts': dict(self.counts) }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        out = cls(snapshot['precision'], snapshot['min_exponent'], snapshot['max_exponent'])
+        for index,count in snapshot['counts'].iteritems():
+            out.counts[int(index)] = count # index may be string if snapshot went through JSON
+            out.total += count
+        return out
+
+    def get_percentile(self, q):
+        """ @param q: percentile between 0 and 100 """
+        if not self.total:
+            return float('nan')
+        rank = max(1, int(math.ceil(self.total*q/100.)))
+        seen = 0
+        for index in sorted(self.counts.keys()):
+            seen += self.counts[index]
+            if seen>=rank:
+                return self._value(index)
+        return self._value(index)
+
+    def _index(self, value):
+        """ map value to bucket: 0 for zero, positive or negative index for positive or negative values """
+        if value==0:
+            return 0
+        mantissa,exponent = math.frexp(abs(value)) # mantissa in [0.5,1)
+        if exponent<self.min_exponent:
+            exponent,mantissa = self.min_exponent,0.5
+        elif exponent>self.max_exponent:
+            exponent,mantissa = self.max_exponent,0.99999999
+        sub_bucket = int((mantissa*2-1)*self.sub_buckets)
+        index = (exponent-self.min_exponent)*self.sub_buckets + sub_bucket + 1
+        return index if value>0 else -index
+
+    def _value(self, index):
+        """ representative value for bucket: midpoint of range of values mapped to it """
+        if index==0:
+            return 0.
+        exponent,sub_bucket = divmod(abs(index)-1, self.sub_buckets)
+        value = math.ldexp((1+(sub_bucket+0.5)/self.sub_buckets)/2, exponent+self.min_exponent)
+        return value if index>0 else -value
+
+def _combine(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """ combine count, mean and sum of squared differences from the mean (m2) of two sets of values
+        (Chan et al. parallel algorithm, avoids cancellation error of sum(x*x)/n - mean*mean)
+        @return: tuple count, mean, m2 for the union of both sets
+    """
+    count = count_a + count_b
+    if not count_b:
+        return count_a, mean_a, m2_a
+    if not count_a:
+        return count_b, mean_b, m2_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta*count_b/count
+    m2 = m2_a + m2_b + delta*delta*count_a*count_b/count
+    return count, mean, m2
+
+def _moments(values):
+    """ @return: tuple count, mean, m2 for a sequence of values """
+    if numpy is not None:
+        values = numpy.asarray(values, dtype=float)
+        mean = float(values.mean())
+        deviations = values - mean
+        return len(values), mean, float(numpy.dot(deviations, deviations))
+    mean = math.fsum(values)/len(values)
+    return len(values), mean, math.fsum([ (value-mean)*(value-mean) for value in values ])
+
+class _HeavyHitters(object):
+    """ Space-Saving sketch (Metwally, Agrawal, El Abbadi 2005): approximate counts for at most capacity labels.
+        any label with more than 1/capacity of all values is guaranteed to be tracked.
+
+        the least frequent label is found with a min-heap holding one (count, label) entry per label.
+        counts only grow, so entries are not updated when a label is counted again: an entry may be lower than
+        the current count, and is only corrected when it reaches the top of the heap.  so counting a tracked label
+        is O(1), and each eviction is O(log capacity) per correction.
+    """
+    def __init__(self, capacity, exempt=()):
+        """ @param exempt: labels that are always kept, and do not use any of the capacity """
+        self.capacity = capacity
+        self.exempt = set(exempt)
+        self.counts = {}
+        self._heap = [] # (count when pushed, label)
+
+    def offer(self, label, count=1):
+        """ @return: label no longer tracked to make room for this one, or None """
+        if label in self.counts:
+            self.counts[label] += count
+        elif label in self.exempt:
+            pass
+        elif len(self.counts)<self.capacity:
+            self.counts[label] = count
+            heapq.heappush(self._heap, (count, label))
+        else:
+            # replace least frequent label, new label inherits its count (which bounds the overestimate)
+            evicted = self._least_frequent()
+            self.counts[label] = self.counts.pop(evicted) + count
+            heapq.heapreplace(self._heap, (self.counts[label], label))
+            return evicted
+
+    def _least_frequent(self):
+        """ @return: label with lowest count, its entry is then at the top of the heap """
+        while True:
+            count,label = self._heap[0]
+            current = self.counts[label]
+            if current==count:
+                return label
+            heapq.heapreplace(self._heap, (current, label))
+
+_OTHER = '__other__'
+
+class _Stats(object):
+    """ values recorded by an Accumulator, or by one thread when the Accumulator is sharded
+
+        keeps running count, mean and m2 (sum of squared differences from the mean) with Welford's method,
+        so standard deviation stays accurate for millions of values of similar magnitude
+    """
+    lock = None # set for each shard of a sharded Accumulator, see Accumulator._get_shard
+    generation = None # for a shard: number of times the Accumulator was cleared when it was registered
+
+    def __init__(self, max_labels=None, exempt=()):
+        """
+        @param max_labels: keep stats for this many of the most frequent labels, combine the rest as __other__
+        @param exempt: labels always kept in addition to max_labels
+        """
+        self.count = { '__total__': 0 }
+        self.mean = {}
+        self.m2 = {}
+        self.min = {}
+        self.max = {}
+        self.histogram = {}
+        self.sketch = _HeavyHitters(max_labels, ('__total__',_OTHER)+tuple(exempt)) if max_labels else None
+
+    def _admit(self, label, count):
+        evicted = self.sketch.offer(label, count)
+        if evicted is not None and evicted in self.mean:
+            # pop count first so readers in other threads skip the label
+            entry = (_OTHER, self.count.pop(evicted), self.mean.pop(evicted), self.m2.pop(evicted),
+                     self.min.pop(evicted), self.max.pop(evicted), self.histogram.pop(evicted))
+            self.merge_entries([entry])
+
+    def add(self, label, value, weight=1):
+        """ @param weight: number of values this one represents """
+        if self.sketch:
+            self._admit(label, weight)
+        if label in self.mean:
+            count = self.count[label]+weight
+            delta = value - self.mean[label]
+            mean = self.mean[label] + delta*weight/count
+            self.m2[label] += weight*delta*(value-mean)
+            self.mean[label] = mean
+            self.count[label] = count
+            self.min[label] = min(value, self.min[label])
+            self.max[label] = max(value, self.max[label])
+            self.histogram[label].add(value, weight)
+        else:
+            # new label: set count last so readers merging from another thread see only complete entries
+            self.histogram[label] = _Histogram()
+            self.histogram[label].add(value, weight)
+            self.m2[label] = 0.
+            self.min[label] = self.max[label] = value
+            self.mean[label] = float(value)
+            self.count[label]=weight
+
+    def add_values(self, label, values):
+        for value in values:
+            self.add(label, value)
+
+    def labels(self):
+        return self.count.keys()
+
+    def entries(self):
+        """ @return: list of (label, count, mean, m2, min, max, histogram) for each label with values """
+        out = []
+        for label in self.count.keys():
+            try:
+                out.append((label, self.count[label], self.mean[label], self.m2[label], self.min[label], self.max[label], self.histogram[label]))
+            except KeyError:
+                pass # no values yet, or folded into __other__ by another thread
+        return out
+
+    def merge(self, other):
+        """ add values recorded in other (_Stats or _ArrayStats) into this """
+        self.merge_entries(other.entries())
+
+    def merge_entries(self, entries):
+        for label,count,mean,m2,min_value,max_value,histogram in entries:
+            if self.sketch:
+                self._admit(label, count)
+            if label in self.mean:
+                self.count[label],self.mean[label],self.m2[label] = _combine(self.count[label], self.mean[label], self.m2[label], count, mean, m2)
+                self.min[label] = min(min_value, self.min[label])
+                self.max[label] = max(max_value, self.max[label])
+            else:
+                self.histogram[label] = _Histogram()
+                self.mean[label] = float(mean)
+                self.m2[label] = m2
+                self.min[label] = min_value
+                self.max[label] = max_value
+                self.count[label] = count
+            self.histogram[label].merge(histogram)
+
+    def get_count(self, key='__total__'):
+        return self.count[key] if key in self.count else 0
+
+    def get_min(self, key='__total__'):
+        return self.min[key] if key in self.min else float('nan')
+    def get_max(self, key='__total__'):
+        return self.max[key] if key in self.max else float('nan')
+
+    def get_percentile(self, key='__total__', q=50):
+        if key not in self.histogram:
+            return float('nan')
+        value = self.histogram[key].get_percentile(q)
+        return min(max(value, self.min[key]), self.max[key])
+
+    def get_average(self, key='__total__'):
+        return self.mean[key]
+
+    def get_standard_deviation(self, key='__total__'):
+        if self.count[key]<2:
+            return float('nan')
+        return math.sqrt(self.m2[key]/self.count[key])
+
+class _ArrayStats(object):
+    """ compact alternative to _Stats: each label is registered once to an integer slot,
+        and stats for all labels are kept in contiguous array('d') columns indexed by slot
+
+        this saves the boxed floats of five dicts, but each label still has its own _Histogram,
+        so memory is about 60% of _Stats with 10000 labels.  add costs about the same as _Stats.add:
+        what is faster is add_values, which updates the columns once for the whole sequence.
+    """
+    lock = None # see _Stats.lock
+    generation = None # see _Stats.generation
+
+    def __init__(self, max_labels=None, exempt=()):
+        """
+        @param max_labels: keep stats for this many of the most frequent labels, combine the rest as __other__
+        @param exempt: labels always kept in addition to max_labels
+        """
+        self.slots = {}
+        self.free_slots = []
+        self.histograms = []
+        self.count = array('d')
+        self.mean = array('d')
+        self.m2 = array('d')
+        self.min = array('d')
+        self.max = array('d')
+        self.sketch = _HeavyHitters(max_labels, ('__total__',_OTHER)+tuple(exempt)) if max_labels else None
+        self._slot('__total__')
+
+    def _slot(self, label, count=1):
+        """ @param count: number of values about to be added for label """
+        if self.sketch:
+            evicted = self.sketch.offer(label, count)
+            if evicted is not None and evicted in self.slots:
+                self._fold(evicted)
+        slot = self.slots.get(label)
+        if slot is None:
+            # fill columns before publishing slot so readers merging from another thread see only complete entries
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.histograms[slot] = _Histogram()
+                for column in self.count, self.mean, self.m2:
+                    column[slot] = 0.
+                self.min[slot] = float('inf')
+                self.max[slot] = float('-inf')
+            else:
+                slot = len(self.count)
+                self.histograms.append(_Histogram())
+                for column in self.count, self.mean, self.m2:
+                    column.append(0.)
+                self.min.append(float('inf'))
+                self.max.append(float('-inf'))
+            self.slots[label] = slot
+        return slot
+
+    def _fold(self, label):
+        """ move stats of label into __other__ and free its slot for reuse """
+        slot = self.slots.pop(label)
+        other = self._slot(_OTHER)
+        self._merge(other, (self.count[slot], self.mean[slot], self.m2[slot]), self.min[slot], self.max[slot])
+        self.histograms[other].merge(self.histograms[slot])
+        self.free_slots.append(slot)
+
+    def add(self, label, value, weight=1):
+        """ @param weight: number of values this one represents """
+        slot = self._slot(label, weight)
+        count = self.count[slot]+weight
+        delta = value - self.mean[slot]
+        mean = self.mean[slot] + delta*weight/count
+        self.m2[slot] += weight*delta*(value-mean)
+        self.mean[slot] = mean
+        self.count[slot] = count
+        if value<self.min[slot]:
+            self.min[slot] = value
+        if value>self.max[slot]:
+            self.max[slot] = value
+        self.histograms[slot].add(value, weight)
+
+    def add_values(self, label, values):
+        """ update stats for many values of one label in a single pass (vectorized if numpy is available) """
+        if not len(values):
+            return
+        if numpy is not None:
+            values = numpy.asarray(values, dtype=float)
+            low,high = values.min(), values.max()
+        else:
+            low,high = min(values), max(values)
+        slot = self._slot(label, len(values))
+        self._merge(slot, _moments(values), low, high)
+        self.histograms[slot].add_values(values)
+
+    def _merge(self, slot, moments, min_value, max_value):
+        count,mean,m2 = _combine(self.count[slot], self.mean[slot], self.m2[slot], *moments)
+        self.count[slot] = count
+        self.mean[slot] = mean
+        self.m2[slot] = m2
+        self.min[slot] = min(self.min[slot], float(min_value))
+        self.max[slot] = max(self.max[slot], float(max_value))
+
+    def labels(self):
+        return self.slots.keys()
+
+    def entries(self):
+        """ @return: list of (label, count, mean, m2, min, max, histogram) for each label with values """
+        return [ (label, int(self.count[slot]), self.mean[slot], self.m2[slot], self.min[slot], self.max[slot], self.histograms[slot])
+                 for label,slot in self.slots.items() if self.count[slot] ]
+
+    def merge(self, other):
+        """ add values recorded in other (_Stats or _ArrayStats) into this """
+        self.merge_entries(other.entries())
+
+    def merge_entries(self, entries):
+        for label,count,mean,m2,min_value,max_value,histogram in entries:
+            slot = self._slot(label, count)
+            self._merge(slot, (count,mean,m2), min_value, max_value)
+            self.histograms[slot].merge(histogram)
+
+    def get_count(self, key='__total__'):
+        slot = self.slots.get(key)
+        return 0 if slot is None else int(self.count[slot])
+
+    def get_min(self, key='__total__'):
+        return self.min[self.slots[key]] if self.get_count(key) else float('nan')
+    def get_max(self, key='__total__'):
+        return self.max[self.slots[key]] if self.get_count(key) else float('nan')
+
+    def get_percentile(self, key='__total__', q=50):
+        if not self.get_count(key):
+            return float('nan')
+        slot = self.slots[key]
+        value = self.histograms[slot].get_percentile(q)
+        return min(max(value, self.min[slot]), self.max[slot])
+
+    def get_average(self, key='__total__'):
+        if not self.get_count(key):
+            raise KeyError(key)
+        return self.mean[self.slots[key]]
+
+    def get_standard_deviation(self, key='__total__'):
+        if self.get_count(key)<2:
+            return float('nan')
+        slot = self.slots[key]
+        return math.sqrt(self.m2[slot]/self.count[slot])
+
+class _Reporter(Thread):
+    """ background thread that formats and logs triggered Accumulator reports,
+        so the thread that adds the triggering value does not pay for formatting and logging
+        and other threads adding values are not blocked meanwhile.
+        also triggers reports for accumulators created with trigger_seconds.
+    """
+    def __init__(self):
+        super(_Reporter,self).__init__(name='accumulator-reporter')
+        self.daemon = True
+        self._queue = Queue()
+        self._lock = Lock()
+        self._schedule = weakref.WeakKeyDictionary() # accumulator -> clock time of next report
+
+    def submit(self, accumulator, parts):
+        self._queue.put((accumulator, parts))
+
+    def schedule(self, accumulator):
+        with self._lock:
+            self._schedule[accumulator] = _clock() + accumulator.trigger_seconds
+        self._queue.put(None) # wake up to recalculate wait time
+
+    def flush(self):
+        self._queue.join()
+
+    def run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._wait_time())
+            except Empty:
+                self._report(None)
+            else:
+                self._report(item)
+                self._queue.task_done() # only after logging, so flush() waits for the report to be written
+
+    def _report(self, item):
+        try:
+            if item:
+                accumulator,parts = item
+                accumulator._log_stats(accumulator._merge(parts))
+            self._run_scheduled()
+        except:
+            log.error('failed to report accumulator', exc_info=True)
+
+    def _wait_time(self):
+        with self._lock:
+            times = self._schedule.values()
+        return max(0, min(times)-_clock()) if times else None
+
+    def _run_scheduled(self):
+        now = _clock()
+        with self._lock:
+            due = [ accumulator for accumulator,when in self._schedule.items() if when<=now ]
+            for accumulator in due:
+                self._schedule[accumulator] = now + accumulator.trigger_seconds
+        for accumulator in due:
+            accumulator._log_stats(accumulator._merge(accumulator._take_report()))
+
+_reporter = None
+_reporter_lock = Lock()
+def _get_reporter():
+    global _reporter
+    with _reporter_lock:
+        if not _reporter:
+            _reporter = _Reporter()
+            _reporter.start()
+        return _reporter
+
+def flush_reports():
+    """ wait until triggered Accumulator reports already submitted to the background reporter have been logged """
+    if _reporter:
+        _reporter.flush()
+
 _persisted_accumulators = {}
 def get_accumulators():
     return _persisted_accumulators
@@ -119,9 +873,33 @@ class Accumulator(_SelfLogging):
             the accumulator will write a log message reporting min, max, average, stddev of each step recorded.
             By default, it then clears stats (so each log message is the most recent N measurements),
             or use trigger_clear=False to keep a running average until an explicit clear().
+        or use Accumulator(trigger_seconds=60) to log results every minute (alone or with trigger_key).
+        triggered reports are formatted and logged by a background thread; the thread adding the triggering value
+        only takes a snapshot of the stats (see flush_reports).  use background=False to log in the adding thread.
+
+        each key also keeps a fixed-size histogram, so callers can get_percentile(step, 99)
+        and reports include the percentiles listed in the percentiles argument.
+
+        with many threads adding to the same Accumulator, use sharded=True: each thread then records into its own stats,
+        taking a lock of its own that only a reader merging that thread's stats contends for, and stats from all threads
+        are merged only when read or reported.  so adding threads are not held up by each other or by a long read,
+        but under the CPython GIL total throughput is about the same as with the shared lock (see benchmark_timer.py).
+
+        partial results from many accumulators (threads, processes, hosts) can be combined exactly with merge(other),
+        or passed around as plain data with snapshot() and Accumulator.from_snapshot(data).
+
+        when tracking many labels, use compact=True to keep stats in arrays indexed by label instead of dictionaries:
+        this saves memory (about 40% with 10000 labels), but add_value costs about the same.
+        add_values(label, values) records a whole sequence at once (in a single vectorized pass if numpy is installed).
+
+        when labels come from data (instrument IDs, stream names, etc), use max_labels=K to limit memory:
+        exact stats are kept for (approximately) the K most frequent labels since each label was last admitted,
+        and values for all other labels are combined under the label __other__.
     """
     def __init__(self, name=None, logger=None, level=logging.INFO, format='%2f', keys='all',
-                 trigger_key=None, trigger_frequency=1000, trigger_clear=True, persist=False):
+                 trigger_key=None, trigger_frequency=1000, trigger_clear=True, persist=False,
+                 percentiles=(50,90,99,99.9), sharded=False, compact=False, trigger_seconds=None, background=True,
+                 max_labels=None):
         """
         @param name: override module name used for default logger with logging.getLogger('stats.'+name)
         @param logger: override default logger with this
@@ -132,26 +910,46 @@ class Accumulator(_SelfLogging):
         @param trigger_frequency: when count of trigger_key is a multiple of this value, log results
         @param trigger_clear: reset counters after triggered report (False=cumulative average since container start, True=current average)
         @param persist: keep a reference to this Accumulator, returned by get_accumulators()
+        @param percentiles: list of percentiles to report with str() or log()
+        @param sharded: keep separate stats for each thread, so threads adding values do not wait for each other (reads are slower)
+        @param compact: keep stats in arrays indexed by label (less memory when there are many labels, and faster add_values)
+        @param trigger_seconds: also log results (and clear, if trigger_clear) every trigger_seconds
+        @param background: format and log triggered reports in a background thread
+        @param max_labels: keep separate stats for at most this many labels (plus __total__, __other__ and trigger_key)
         """
         super(Accumulator,self).__init__(name, logger, level, 'stats')
         self.lock = Lock()
         self.format = '%d values: ' + format + ' min, ' + format + ' avg, ' + format + ' max, ' + format + ' dev'
+        self.percentiles = percentiles
+        self.percentile_format = ', ' + format + ' p%s'
         self.keys_arg = keys
         self.trigger_key = trigger_key
         self.trigger_frequency = trigger_frequency
         self.trigger_clear = trigger_clear
+        self.sharded = sharded
+        self.compact = compact
+        self.trigger_seconds = trigger_seconds
+        self.background = background
+        self.max_labels = max_labels
+        self.sampler = None # set by Sampler feeding this Accumulator, to report sample rate
+        self._generation = 0 # sharded: number of times shards were replaced, see _lock_shard
         self.clear()
+        if trigger_seconds:
+            _get_reporter().schedule(self)
         if persist:
             global _persisted_accumulators
             _persisted_accumulators[self.name] = self
 
     def keys(self):
+        return self._keys(self._read())
+
+    def _keys(self, stats):
         if self.keys_arg == 'all':
-            return self.count.keys()
+            return stats.labels()
         elif self.keys_arg == 'total':
             return ['__total__']
         elif self.keys_arg == '!total':
-            out = self.count.keys()
+            out = stats.labels()
             out.remove('__total__')
             return out
         else:
@@ -159,83 +957,626 @@ class Accumulator(_SelfLogging):
 
     def clear(self):
         with self.lock:
-            self.count = { '__total__': 0 }
-            self.min = {}
-            self.sum = {}
-            self.sumsquares = {}
-            self.min = {}
-            self.max = {}
+            self._clear()
 
-    def add(self, timer):
+    def _clear(self):
+        """ always called while holding lock """
+        if self.sharded:
+            # threads find no shard in the new thread-local and register a fresh one
+            self._shards = []
+            self._local = local()
+            self._generation += 1
+            self._trigger_count = itertools.count(1)
+        else:
+            self._stats = self._new_stats()
+
+    def _new_stats(self):
+        exempt = (self.trigger_key,) if self.trigger_key else ()
+        return _ArrayStats(self.max_labels, exempt) if self.compact else _Stats(self.max_labels, exempt)
+
+    def _writable_stats(self):
+        """ stats that new values are added to when not sharded, always called while holding lock """
+        return self._stats
+
+    def _count_trigger_key(self):
+        """ always called while holding lock """
+        return self._stats.get_count(self.trigger_key)
+
+    def _parts(self):
+        """ @return: list of stats that together hold all values added, one per thread if sharded """
+        return list(self._shards) if self.sharded else [ self._stats ]
+
+    def _read(self):
+        """ get stats to report: for sharded accumulator, a merged copy of all threads' stats """
+        return self._merge(self._parts())
+
+    def _merge(self, parts):
+        """ @param parts: stats no longer written to, or shards (each is merged under its own lock) """
+        if len(parts)==1 and not parts[0].lock:
+            return parts[0]
+        return self._copy(parts)
+
+    def _copy(self, parts):
+        """ @return: new stats with all values of parts
+            caller must hold lock unless parts are shards or no longer written to
+        """
+        out = self._new_stats()
+        for stats in parts:
+            if stats.lock:
+                with stats.lock:
+                    out.merge(stats)
+            else:
+                out.merge(stats)
+        return out
+
+    def _get_shard(self):
+        stats = getattr(self._local, 'stats', None)
+        if stats is None:
+            stats = self._new_stats()
+            stats.lock = Lock() # only contended while stats of this thread are being merged
+            with self.lock:
+                stats.generation = self._generation
+                self._local.stats = stats
+                self._shards.append(stats)
+        return stats
+
+    def _lock_shard(self):
+        """ @return: this thread's shard with its lock acquired, caller must release stats.lock
+
+            the shard may be taken for a report (and replaced) after this thread gets it but before it is locked:
+            then it is fetched again, so the value is not added to stats that were already merged into the report
+        """
+        while True:
+            stats = self._get_shard()
+            stats.lock.acquire()
+            if stats.generation==self._generation:
+                return stats
+            stats.lock.release()
+
+    def add(self, timer, weight=1):
+        """ @param weight: number of timed operations this timer represents (for example, 1 in weight is sampled) """
         new_values = []
-        for pair_o_tuples in zip(timer.times[:-1], timer.times[1:], xrange(len(timer.times)-1)):
-            label = pair_o_tuples[1][0] or str(pair_o_tuples[2])
-            delta = pair_o_tuples[1][1]-pair_o_tuples[0][1]
-            new_values.append((label,delta))
+        for index,(label,delta) in enumerate(timer.get_steps()):
+            new_values.append((label or str(index), delta))
+        new_values.append(('__total__', timer._elapsed()))
+        new_values.extend(timer.get_resource_steps())
+        if self.sharded:
+            self._add_sharded(new_values, weight)
+            return
         with self.lock:
+            before = self._count_trigger_key() if weight>1 else None
             for label,delta in new_values:
-                self.add_value(label, delta, _can_trigger=False, _have_lock=True)
-            self._check_trigger()
+                self.add_value(label, delta, weight, _can_trigger=False, _have_lock=True)
+            self._check_trigger(before)
 
-    def add_value(self, label, value, _can_trigger=True, _have_lock=False):
+    def add_value(self, label, value, weight=1, _can_trigger=True, _have_lock=False):
         """
+        @param weight: number of values this one represents (for example, 1 in weight is sampled)
         @param _can_trigger: when called from add(Timer), avoid trigger until whole Timer is added
         @param _have_lock: when called from add(Timer), don't need to re-acquire the lock
         """
-        if not _have_lock:
+        if self.sharded:
+            self._add_sharded([(label,value)], weight)
+        elif not _have_lock:
             with self.lock:
-                self.add_value(label, value, _can_trigger=_can_trigger, _have_lock=True)
+                self.add_value(label, value, weight, _can_trigger=_can_trigger, _have_lock=True)
         else:
-            if label in self.sum:
-                self.count[label]+=1
-                self.sum[label] += value
-                self.sumsquares[label] += value*value
-                self.min[label] = min(value, self.min[label])
-                self.max[label] = max(value, self.max[label])
-            else:
-                self.count[label]=1
-                self.sumsquares[label] = value*value
-                self.min[label] = self.max[label] = self.sum[label] = value
+            before = self._count_trigger_key() if _can_trigger and weight>1 else None
+            self._writable_stats().add(label, value, weight)
             if _can_trigger:
-                self._check_trigger()
+                self._check_trigger(before)
+
+    def add_values(self, label, values):
+        """ record a sequence of values for one label, faster than calling add_value for each """
+        if self.sharded:
+            stats = self._lock_shard()
+            try:
+                stats.add_values(label, values)
+            finally:
+                stats.lock.release()
+            self._count_sharded_trigger(len(values) if label==self.trigger_key else 0)
+        else:
+            with self.lock:
+                before = self._count_trigger_key()
+                self._writable_stats().add_values(label, values)
+                self._check_trigger(before)
+
+    def _add_sharded(self, values, weight=1):
+        """ record into this thread's shard, taking only the lock of the shard """
+        stats = self._lock_shard()
+        trigger_values = 0
+        try:
+            for label,value in values:
+                stats.add(label, value, weight)
+                if label==self.trigger_key:
+                    trigger_values += weight
+        finally:
+            stats.lock.release()
+        self._count_sharded_trigger(trigger_values)
 
-    def _check_trigger(self):
+    def _count_sharded_trigger(self, count):
+        """ count trigger_key values across all threads, report if count passed a multiple of trigger_frequency """
+        triggered = False
+        for n in xrange(count):
+            # next() on itertools.count is atomic, so no two threads see the same count
+            if self._trigger_count.next()%self.trigger_frequency==0:
+                triggered = True
+        if triggered:
+            with self.lock:
+                self._report()
+
+    def _check_trigger(self, before=None):
+        """ always called while holding lock
+            @param before: count of trigger_key before adding several values at once
+        """
+        count = self._count_trigger_key()
+        if before is not None:
+            if self.trigger_key and count/self.trigger_frequency>before/self.trigger_frequency:
+                self._report()
+        elif self.trigger_key and count and count%self.trigger_frequency==0:
+            self._report()
+
+    def _report(self):
         """ always called while holding lock """
-        if self.trigger_key and self.count[self.trigger_key] and self.count[self.trigger_key]%self.trigger_frequency==0:
-            self.log()
-            if self.trigger_clear:
-                self.clear()
+        if not self.background:
+            if self.sharded and self.trigger_clear:
+                # replace shards before reading them: a value added meanwhile goes to a new shard instead of being cleared unreported
+                self._log_stats(self._merge(self._take_report(_have_lock=True)))
+            else:
+                self.log()
+                if self.trigger_clear:
+                    self._clear()
+        elif self.is_log_enabled():
+            _get_reporter().submit(self, self._take_report(_have_lock=True))
+        elif self.trigger_clear:
+            self._clear()
+
+    def _take_report(self, _have_lock=False):
+        """ get stats to report (merged later by the reporter thread), and clear if trigger_clear.
+            with trigger_clear this is O(1): the stats are swapped for new ones, not copied.
+            otherwise the stats are copied, since they keep changing while the reporter formats them.
+        """
+        if not _have_lock:
+            with self.lock:
+                return self._take_report(_have_lock=True)
+        parts = self._parts()
+        if self.trigger_clear:
+            self._clear()
+            return parts
+        return [ self._copy(parts) ]
+
+    def _log_stats(self, stats):
+        if self.is_log_enabled():
+            self.logger.log(self.level, self._format(stats))
+
+    def merge(self, other):
+        """ add all values recorded in another Accumulator into this one (does not trigger a report) """
+        entries = other._read_copy().entries()
+        if self.sharded:
+            stats = self._lock_shard()
+            try:
+                stats.merge_entries(entries)
+            finally:
+                stats.lock.release()
+        else:
+            with self.lock:
+                self._writable_stats().merge_entries(entries)
+
+    def snapshot(self):
+        """ @return: current stats as a dict of plain values (suitable for pickle or json), see from_snapshot() """
+        stats = {}
+        for label,count,mean,m2,min_value,max_value,histogram in self._read_copy().entries():
+            stats[label] = { 'count': count, 'mean': mean, 'm2': m2, 'min': min_value, 'max': max_value,
+                             'histogram': histogram.snapshot() }
+        return { 'name': self.name, 'stats': stats }
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        """ create Accumulator with stats from snapshot()
+            @param kwargs: other arguments to Accumulator(), name defaults to name of accumulator in snapshot
+        """
+        kwargs.setdefault('name', snapshot['name'])
+        out = cls(**kwargs)
+        entries = [ (label, value['count'], value['mean'], value['m2'], value['min'], value['max'], _Histogram.from_snapshot(value['histogram']))
+                    for label,value in snapshot['stats'].iteritems() ]
+        if out.sharded:
+            out._get_shard().merge_entries(entries)
+        else:
+            out._writable_stats().merge_entries(entries)
+        return out
+
+    def _read_copy(self):
+        """ get stats that will not change while caller reads them """
+        if self.sharded:
+            return self._read()
+        with self.lock:
+            return self._copy(self._parts())
 
     def get_count(self, key='__total__'):
-        return self.count[key] if key in self.count else 0
+        return self._read().get_count(key)
 
     def get_min(self, key='__total__'):
-        return self.min[key] if key in self.min else float('nan')
+        return self._read().get_min(key)
     def get_max(self, key='__total__'):
-        return self.max[key] if key in self.max else float('nan')
+        return self._read().get_max(key)
+
+    def get_percentile(self, key='__total__', q=50):
+        """ @param q: percentile between 0 and 100, result is approximate but always within min..max """
+        return self._read().get_percentile(key, q)
 
     def get_average(self, key='__total__'):
-        return self.sum[key] / self.count[key]
+        return self._read().get_average(key)
 
     def get_standard_deviation(self, key='__total__'):
-        if self.count[key]<2:
-            return float('nan')
-        avg = self.get_average(key=key)
-        return math.sqrt(self.sumsquares[key]/self.count[key]-avg*avg)
+        return self._read().get_standard_deviation(key)
 
     def __len__(self):
         return len(self.keys())
 
     def __str__(self):
-        return '\n'.join(['%s: %s' % (key,self.to_string(key)) for key in self.keys()])
+        return self._format(self._read())
+
+    def _format(self, stats):
+        lines = ['%s: %s' % (key,self._to_string(stats, key)) for key in self._keys(stats)]
+        if self.sampler:
+            lines.insert(0, str(self.sampler))
+        return '\n'.join(lines)
 
     def to_string(self, key='__total__'):
-        count = self.get_count(key)
+        return self._to_string(self._read(), key)
+
+    def _to_string(self, stats, key):
+        count = stats.get_count(key)
         if count:
-            return self.format % ( count, self.get_min(key), self.get_average(key),
-                                    self.get_max(key), self.get_standard_deviation(key))
+            out = self.format % ( count, stats.get_min(key), stats.get_average(key),
+                                   stats.get_max(key), stats.get_standard_deviation(key))
+            for q in self.percentiles:
+                out += self.percentile_format % (stats.get_percentile(key, q), q)
+            return out
         else:
             return 'no values reported'
 
     def log(self):
-        self._log()
\ No newline at end of file
+        self._log()
+
+
+class WindowedAccumulator(Accumulator):
+    """ Accumulator that reports stats for values added during the last window_seconds only
+
+        values are added to one of a ring of buckets, each covering window_seconds/buckets.
+        moving to the next bucket drops the oldest one in O(1), so the window slides forward without keeping raw values.
+        queries (get_min, get_average, get_percentile, etc) merge the live buckets, so they cover between
+        window_seconds*(buckets-1)/buckets and window_seconds of the most recent values.
+
+        trigger_key and trigger_frequency work as in Accumulator, counting values of trigger_key within the window.
+    """
+    def __init__(self, window_seconds=60, buckets=12, **kwargs):
+        """
+        @param window_seconds: length of time covered by stats
+        @param buckets: number of intervals the window is divided into (more buckets: smoother window, slower queries)
+        @param kwargs: other arguments to Accumulator (sharded is not supported)
+        """
+        if kwargs.get('sharded'):
+            raise ValueError('WindowedAccumulator cannot be sharded')
+        self.bucket_count = buckets
+        self.bucket_seconds = float(window_seconds)/buckets
+        self._clock = _clock
+        super(WindowedAccumulator,self).__init__(**kwargs)
+        self.lock = RLock() # reads take the lock, and a report triggered while holding it reads the stats
+
+    def _clear(self):
+        """ always called while holding lock """
+        self._buckets = [None]*self.bucket_count
+        self._intervals = [None]*self.bucket_count # which interval each bucket holds values for
+
+    def _writable_stats(self):
+        interval = int(self._clock()/self.bucket_seconds)
+        slot = interval%self.bucket_count
+        if self._intervals[slot]!=interval:
+            # bucket is from an older interval: replace it (readers may still be merging the old one)
+            self._buckets[slot] = self._new_stats()
+            self._intervals[slot] = interval
+        return self._buckets[slot]
+
+    def _live_buckets(self):
+        oldest = int(self._clock()/self.bucket_seconds) - self.bucket_count
+        return [ stats for interval,stats in zip(self._intervals, self._buckets) if interval is not None and interval>oldest ]
+
+    def _count_trigger_key(self):
+        return sum([ stats.get_count(self.trigger_key) for stats in self._live_buckets() ])
+
+    def _parts(self):
+        return self._live_buckets()
+
+    def _read(self):
+        """ merged copy of the live buckets: values are added to the current bucket while it is read """
+        return self._read_copy()
+
+    def _read_copy(self):
+        with self.lock:
+            return self._copy(self._live_buckets())
+
+
+_persisted_slow_logs = {}
+def get_slow_logs():
+    return _persisted_slow_logs
+
+class SlowLog(_SelfLogging):
+    """ keep the N slowest Timers added for each timer name, with the time of every step
+
+        use instead of Timer.log(min=...) to see where tail latency goes without logging every timer:
+            slow = SlowLog(size=20, persist=True)
+            ...
+            t = Timer()
+            ...
+            slow.add(t)
+        then later query with get_slowest(name) or write all with log() or str()
+    """
+    def __init__(self, name=None, logger=None, level=logging.INFO, size=10, persist=False, milliseconds=True, number_format='%f'):
+        """
+        @param name: override module name used for default logger with logging.getLogger('stats.'+name)
+        @param logger: override default logger with this
+        @param level: log slow timers at this log level
+        @param size: number of timers to keep for each timer name
+        @param persist: keep a reference to this SlowLog, returned by get_slow_logs()
+        @param milliseconds: report time in milliseconds (vs seconds)?
+        @param number_format: '%f' used by default
+        """
+        super(SlowLog,self).__init__(name, logger, level, 'stats')
+        self.size = size
+        self.lock = Lock()
+        self.multiplier = 1000 if milliseconds else 1
+        self.number_format = number_format
+        self._heaps = {} # timer name -> min-heap of (elapsed, sequence, wall time, steps), fastest kept timer first
+        self._sequence = itertools.count()
+        if persist:
+            global _persisted_slow_logs
+            _persisted_slow_logs[self.name] = self
+
+    def add(self, timer):
+        """ keep timer if it is one of the slowest with its name.  O(1) if it is not, O(log size) if it is """
+        elapsed = timer._elapsed()
+        heap = self._heaps.get(timer.name)
+        if heap and len(heap)>=self.size and elapsed<=heap[0][0]:
+            return # faster than all kept timers: skip without locking
+        entry = (elapsed, self._sequence.next(), time.time(), list(timer.get_steps()))
+        with self.lock:
+            heap = self._heaps.setdefault(timer.name, [])
+            if len(heap)<self.size:
+                heapq.heappush(heap, entry)
+            elif elapsed>heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+    def names(self):
+        return self._heaps.keys()
+
+    def get_slowest(self, name):
+        """ @return: list of (elapsed, wall time when added, [(label,seconds), ...]), slowest first """
+        with self.lock:
+            entries = list(self._heaps.get(name, []))
+        return [ (elapsed, when, steps) for elapsed,sequence,when,steps in sorted(entries, reverse=True) ]
+
+    def clear(self):
+        with self.lock:
+            self._heaps = {}
+
+    def __str__(self):
+        lines = []
+        for name in sorted(self.names()):
+            lines.append('%s: %d slowest' % (name, self.size))
+            for elapsed,when,steps in self.get_slowest(name):
+                line = '  ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)) + ' elapsed ' + self.number_format%(self.multiplier*elapsed) + ':'
+                for index,(label,delta) in enumerate(steps):
+                    line += ' %s=' % (label or index) + self.number_format%(self.multiplier*delta)
+                lines.append(line)
+        return '\n'.join(lines)
+
+    def log(self):
+        self._log()
+
+
+class _NullTimer(object):
+    """ stands in for a Timer on calls that a Sampler does not time: does nothing, one shared instance """
+    __slots__ = []
+    def complete_step(self, label=None):
+        pass
+    def step(self, label):
+        return self
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+    def log(self, min=0):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class Sampler(object):
+    """ time only 1 in rate calls, to limit the cost of timing very frequent operations
+
+        use like this:
+            sampler = Sampler(accumulator, samples_per_second=100)
+            ...
+            t = sampler.start()
+            decode(message)
+            t.complete_step('decode')
+            sampler.add(t)
+
+        on calls that are not sampled, start() returns a shared timer that does nothing:
+        no Timer is created, no clock is read and no lock is taken.
+        each sampled timer is added to the accumulator with weight=rate, so counts in the accumulator
+        estimate the number of calls (other stats are not affected by uniform sampling),
+        and the accumulator reports the current sample rate with its stats.
+
+        with samples_per_second or max_overhead, the rate is recalculated every adjust_seconds.
+        max_overhead is estimated from time taken to create sampled timers and add them to the accumulator
+        (not time taken by each step), as a fraction of elapsed time.
+    """
+    def __init__(self, accumulator, rate=1, samples_per_second=None, max_overhead=None, adjust_seconds=1.,
+                 max_rate=1000000, timer_class=None):
+        """
+        @param accumulator: add sampled timers to this Accumulator
+        @param rate: time 1 of this many calls (initial value if samples_per_second or max_overhead is used)
+        @param samples_per_second: adjust rate to time about this many calls per second
+        @param max_overhead: adjust rate to keep cost of sampled timers below this fraction of time (ie- 0.01 for 1%)
+        @param adjust_seconds: how often to recalculate rate
+        @param max_rate: never sample less often than 1 in this many calls
+        @param timer_class: create sampled timers of this class (default MonotonicTimer)
+        """
+        self.accumulator = accumulator
+        self.rate = rate
+        self.samples_per_second = samples_per_second
+        self.max_overhead = max_overhead
+        self.adjust_seconds = adjust_seconds
+        self.max_rate = max_rate
+        self.timer_class = timer_class or MonotonicTimer
+        self._countdown = 1 # time first call
+        self._calls = 0
+        self._samples = 0
+        self._cost = 0.
+        self._period_start = _clock()
+        accumulator.sampler = self
+
+    def start(self):
+        """ @return: new Timer if this call is sampled, otherwise a shared Timer that does nothing """
+        # not locked: concurrent callers may occasionally sample one call more or fewer
+        self._countdown -= 1
+        if self._countdown>0:
+            return _NULL_TIMER
+        start = _clock()
+        self._countdown = self.rate
+        timer = self.timer_class(name=self.accumulator.name)
+        timer.sample_weight = self.rate
+        self._cost += _clock()-start
+        return timer
+
+    def add(self, timer):
+        """ add timer from start() to accumulator, if it was sampled """
+        if timer is _NULL_TIMER:
+            return
+        start = _clock()
+        self.accumulator.add(timer, weight=timer.sample_weight)
+        now = _clock()
+        self._cost += now-start
+        self._calls += timer.sample_weight
+        self._samples += 1
+        if now-self._period_start>=self.adjust_seconds:
+            self._adjust(now)
+
+    def _adjust(self, now):
+        elapsed = now-self._period_start
+        rate = self.rate
+        if self.samples_per_second:
+            rate = self._calls/elapsed/self.samples_per_second
+        elif self.max_overhead:
+            rate = self.rate*(self._cost/elapsed)/self.max_overhead
+        self.rate = max(1, min(self.max_rate, int(round(rate))))
+        self._countdown = min(self._countdown, self.rate)
+        self._calls = self._samples = 0
+        self._cost = 0.
+        self._period_start = now
+
+    def __str__(self):
+        return 'sampling 1 in %d calls' % self.rate
+
+
+_persisted_meters = {}
+def get_meters():
+    return _persisted_meters
+
+class Meter(_SelfLogging):
+    """ measure rate of events: lifetime mean and exponentially weighted averages over 1, 5 and 15 minutes
+
+        call mark() once per message (or mark(n) for a batch of n):
+            meter = Meter(name='ingest', persist=True)
+            ...
+            meter.mark()
+        then get_one_minute_rate() etc, or log() to report all rates in events per second.
+
+        mark() only adds to a counter; the moving averages are updated every tick_seconds,
+        when the next mark() or query finds a tick has passed.  after idle periods all missed ticks
+        are applied at once, so every call is O(1).
+    """
+    _WINDOWS = (60., 300., 900.)
+
+    def __init__(self, name=None, logger=None, level=logging.INFO, persist=False, tick_seconds=5., number_format='%.2f'):
+        """
+        @param name: override module name used for default logger with logging.getLogger('stats.'+name)
+        @param logger: override default logger with this
+        @param level: log rates at this log level
+        @param persist: keep a reference to this Meter, returned by get_meters()
+        @param tick_seconds: how often to update moving averages
+        @param number_format: '%.2f' used by default
+        """
+        super(Meter,self).__init__(name, logger, level, 'stats')
+        self.tick_seconds = float(tick_seconds)
+        self.number_format = number_format
+        self.lock = Lock()
+        self._clock = _clock
+        self._alphas = [ 1-math.exp(-self.tick_seconds/window) for window in self._WINDOWS ]
+        self.clear()
+        if persist:
+            global _persisted_meters
+            _persisted_meters[self.name] = self
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+            self._uncounted = 0 # events since last tick
+            self._rates = None # per second for each window, None until first tick
+            self._start = self._last_tick = self._clock()
+
+    def mark(self, n=1):
+        """ record n events """
+        now = self._clock()
+        with self.lock:
+            if now-self._last_tick>=self.tick_seconds:
+                self._tick(now)
+            self._uncounted += n
+            self.count += n
+
+    def _tick(self, now):
+        """ always called while holding lock """
+        ticks = int((now-self._last_tick)/self.tick_seconds)
+        self._last_tick += ticks*self.tick_seconds
+        instant = self._uncounted/self.tick_seconds
+        self._uncounted = 0
+        if self._rates is None:
+            rates = [ instant ]*len(self._alphas)
+        else:
+            rates = [ rate + alpha*(instant-rate) for rate,alpha in zip(self._rates, self._alphas) ]
+        if ticks>1:
+            # no events in the rest of the ticks: each decays the rate by (1-alpha)
+            rates = [ rate*(1-alpha)**(ticks-1) for rate,alpha in zip(rates, self._alphas) ]
+        self._rates = rates
+
+    def _get_rate(self, index):
+        now = self._clock()
+        with self.lock:
+            if now-self._last_tick>=self.tick_seconds:
+                self._tick(now)
+            return self._rates[index] if self._rates else 0.
+
+    def get_count(self):
+        return self.count
+
+    def get_mean_rate(self):
+        elapsed = self._clock()-self._start
+        return self.count/elapsed if elapsed>0 else 0.
+
+    def get_one_minute_rate(self):
+        return self._get_rate(0)
+
+    def get_five_minute_rate(self):
+        return self._get_rate(1)
+
+    def get_fifteen_minute_rate(self):
+        return self._get_rate(2)
+
+    def __str__(self):
+        rates = tuple([ self.number_format % rate for rate in
+                        (self.get_mean_rate(), self.get_one_minute_rate(), self.get_five_minute_rate(), self.get_fifteen_minute_rate()) ])
+        return '%d events, mean %s/sec, 1min %s/sec, 5min %s/sec, 15min %s/sec' % ((self.count,) + rates)
+
+    def log(self):
+        self._log()
@@ -0,0 +1,69 @@
+"""
+benchmark of DirectoryPoller scan cost -- not unit tests, run directly:
+
+    PYTHONPATH=src python test/ooi/benchmark_poller.py [entries ...]
+
+default directory sizes are 10k, 100k and 1M entries (1M takes a few minutes to create)
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+from ooi.poller import DirectoryPoller
+
+def _glob_scan(path, last_filename):
+    """ scan used before incremental scanning, for comparison: full glob, sort, then index of last file found """
+    filenames = sorted(glob.glob(path))
+    position = filenames.index(last_filename)
+    return filenames[position+1:]
+
+def create_files(directory, count):
+    for n in xrange(count):
+        os.close(os.open('%s/A%07d.DAT' % (directory, n), os.O_CREAT|os.O_WRONLY))
+
+def timed(function, repeat=3):
+    """ @return: best of repeat times to call function, in milliseconds """
+    best = None
+    for n in xrange(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time()-start
+        best = elapsed if best is None else min(best, elapsed)
+    return best*1000
+
+def scan_cost(count):
+    """ @return: milliseconds for old glob scan, new scan after a file was added, and new check of an unchanged directory """
+    directory = tempfile.mkdtemp()
+    try:
+        create_files(directory, count)
+        old = timed(lambda: _glob_scan(directory + '/A*.DAT', '%s/A%07d.DAT' % (directory, count-1)))
+
+        poller = DirectoryPoller(directory, 'A*.DAT', None, inotify=False)
+        poller._check_for_files()
+        added = [ count ]
+        def add_and_scan():
+            os.close(os.open('%s/A%07d.DAT' % (directory, added[0]), os.O_CREAT|os.O_WRONLY))
+            added[0] += 1
+            assert len(poller._check_for_files())==1
+        changed = timed(add_and_scan)
+
+        poller._scan_time += 10 # as if last change was long before last scan
+        unchanged = timed(lambda: poller._check_for_files(), repeat=100)
+        return old, changed, unchanged
+    finally:
+        shutil.rmtree(directory)
+
+def report_scan_cost(sizes):
+    print 'DirectoryPoller scan cost (milliseconds):'
+    print '%10s %12s %12s %12s' % ('entries', 'glob+index', 'changed', 'unchanged')
+    for count in sizes:
+        old, changed, unchanged = scan_cost(count)
+        print '%10d %12.2f %12.2f %12.3f' % (count, old, changed, unchanged)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    sizes = [ int(arg) for arg in sys.argv[1:] ] or [ 10000, 100000, 1000000 ]
+    report_scan_cost(sizes)
@@ -0,0 +1,107 @@
+"""
+micro-benchmarks for ooi.timer -- not unit tests, run directly:
+
+    PYTHONPATH=src python test/ooi/benchmark_timer.py
+"""
+
+import time
+import inspect
+from threading import Thread
+import ooi.timer
+
+def accumulator_throughput(sharded, thread_count, values_per_thread=100000):
+    """ @return: values added per second with thread_count threads adding to one Accumulator """
+    a = ooi.timer.Accumulator(name='benchmark', sharded=sharded)
+    def add_values():
+        for value in xrange(values_per_thread):
+            a.add_value('publish', value)
+    threads = [ Thread(target=add_values) for n in xrange(thread_count) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time()-start
+    return thread_count*values_per_thread/elapsed
+
+def report_accumulator_scaling():
+    print 'Accumulator.add_value throughput (values/second):'
+    print '%8s %12s %12s' % ('threads', 'locked', 'sharded')
+    for thread_count in [ 1, 2, 4, 8, 16, 32 ]:
+        print '%8d %12d %12d' % (thread_count, accumulator_throughput(False, thread_count), accumulator_throughput(True, thread_count))
+
+def storage_cost(compact, label_count=500, values_per_label=200):
+    """ @return: seconds per add_value and per value in add_values with label_count labels """
+    labels = [ 'step%d' % n for n in xrange(label_count) ]
+    values = [ float(n) for n in xrange(values_per_label) ]
+    a = ooi.timer.Accumulator(name='benchmark', compact=compact)
+    start = time.time()
+    for value in values:
+        for label in labels:
+            a.add_value(label, value)
+    single = (time.time()-start)/(label_count*values_per_label)
+    a.clear()
+    start = time.time()
+    for label in labels:
+        a.add_values(label, values)
+    bulk = (time.time()-start)/(label_count*values_per_label)
+    return single, bulk
+
+def report_storage_cost():
+    print 'Accumulator cost per value with 500 labels (microseconds):'
+    print '%8s %12s %12s' % ('storage', 'add_value', 'add_values')
+    for compact in False, True:
+        single, bulk = storage_cost(compact)
+        print '%8s %12.3f %12.3f' % ('compact' if compact else 'dict', single*1e6, bulk*1e6)
+
+def step_cost(timer_class, steps=200000, use_with=False):
+    """ @return: nanoseconds per step recorded """
+    t = timer_class(name='benchmark', capacity=steps) if timer_class is ooi.timer.MonotonicTimer else timer_class(name='benchmark')
+    start = time.time()
+    if use_with:
+        for n in xrange(steps):
+            with t.step('step'):
+                pass
+    else:
+        for n in xrange(steps):
+            t.complete_step('step')
+    return (time.time()-start)*1e9/steps
+
+def report_step_cost():
+    print 'Timer overhead (nanoseconds per step):'
+    print '%32s %8d' % ('Timer.complete_step', step_cost(ooi.timer.Timer))
+    print '%32s %8d' % ('MonotonicTimer.complete_step', step_cost(ooi.timer.MonotonicTimer))
+    print '%32s %8d' % ('with MonotonicTimer.step()', step_cost(ooi.timer.MonotonicTimer, use_with=True))
+
+def _inspect_stack_lookup():
+    """ caller lookup used before ooi.timer walked frames directly, for comparison """
+    frame = inspect.stack()[1]
+    return inspect.getmodule(frame[0]).__name__
+
+def creation_cost(create, count=20000):
+    """ @return: microseconds per call of create() """
+    start = time.time()
+    for n in xrange(count):
+        create()
+    return (time.time()-start)*1e6/count
+
+def report_creation_cost():
+    print 'Timer creation (microseconds):'
+    print '%32s %8.2f' % ('Timer(name=...)', creation_cost(lambda: ooi.timer.Timer(name='benchmark')))
+    print '%32s %8.2f' % ('Timer()', creation_cost(ooi.timer.Timer))
+    print '%32s %8.2f' % ('caller lookup, frame walk', creation_cost(ooi.timer._get_calling_module))
+    print '%32s %8.2f' % ('caller lookup, inspect.stack()', creation_cost(_inspect_stack_lookup, count=2000))
+
+def report_meter_cost(count=200000):
+    m = ooi.timer.Meter(name='benchmark')
+    start = time.time()
+    for n in xrange(count):
+        m.mark()
+    print 'Meter.mark (nanoseconds): %d' % ((time.time()-start)*1e9/count)
+
+if __name__ == '__main__':
+    report_accumulator_scaling()
+    report_storage_cost()
+    report_step_cost()
+    report_creation_cost()
+    report_meter_cost()
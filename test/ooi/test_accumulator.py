@@ -3,6 +3,10 @@ import unittest
 import time
 import ooi.timer
 from math import fabs
+from threading import Thread
+import json
+import logging
+from random import Random
 class TestTimer(TestCase):
 
     def test_use_case_example(self):
@@ -29,5 +33,269 @@ class TestTimer(TestCase):
         print str(a)
         # self.assertNothingCrashed()
 
+    def test_percentiles(self):
+        a = ooi.timer.Accumulator()
+        for value in xrange(1,1001):
+            a.add_value('step', value/1000.)
+        self.assertAlmostEqual(0.5, a.get_percentile('step', 50), delta=0.5/32)
+        self.assertAlmostEqual(0.99, a.get_percentile('step', 99), delta=0.99/32)
+        self.assertEquals(1.0, a.get_percentile('step', 100))
+        self.assertEquals(0.001, a.get_percentile('step', 0))
+        self.assertTrue('p99.9' in a.to_string('step'))
+
+    def test_histogram_memory_is_bounded(self):
+        a = ooi.timer.Accumulator()
+        for exponent in xrange(-100,100):
+            for value in xrange(100):
+                a.add_value('step', value*10.**exponent)
+        histogram = a._stats.histogram['step']
+        self.assertEquals(20000, histogram.total)
+        self.assertTrue(len(histogram.counts) <= (histogram.max_exponent-histogram.min_exponent+1)*histogram.sub_buckets+1)
+
+    def test_sharded(self):
+        a = ooi.timer.Accumulator(sharded=True, trigger_key='step', trigger_frequency=250, trigger_clear=False, background=False)
+        reports = []
+        a.log = lambda: reports.append(a.get_count('step'))
+        def add_values():
+            for value in xrange(100):
+                a.add_value('step', float(value))
+        threads = [ Thread(target=add_values) for n in xrange(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(5, len(a._shards))
+        self.assertEquals(500, a.get_count('step'))
+        self.assertEquals(49.5, a.get_average('step'))
+        self.assertEquals(99, a.get_max('step'))
+        self.assertEquals(2, len(reports))
+
+    def test_sharded_read_while_adding(self):
+        a = ooi.timer.Accumulator(sharded=True)
+        def add_values(thread):
+            for value in xrange(20000):
+                a.add_value('%d-%d' % (thread, value%50), float(value)) # new labels and buckets while reading
+        threads = [ Thread(target=add_values, args=(n,)) for n in xrange(4) ]
+        for thread in threads:
+            thread.start()
+        reads = 0
+        while any([ thread.is_alive() for thread in threads ]):
+            str(a)
+            a.get_percentile('0-1', 99)
+            reads += 1
+        for thread in threads:
+            thread.join()
+        self.assertTrue(reads>1)
+        self.assertEquals(80000, sum([ a.get_count(key) for key in a.keys() ]))
+        self.assertEquals(200, len(a.keys())-1)
+
+        a.clear()
+        self.assertEquals(0, a.get_count('step'))
+        a.add_value('step', 3)
+        self.assertEquals(3, a.get_average('step'))
+
+    def test_sharded_report_while_adding(self):
+        for background in True, False:
+            a = ooi.timer.Accumulator(sharded=True, trigger_key='step', trigger_frequency=100, background=background, level=logging.CRITICAL)
+            reports = []
+            a._log_stats = lambda stats: reports.append(stats.get_count('step'))
+            def add_values():
+                for value in xrange(20000):
+                    a.add_value('step', float(value))
+            threads = [ Thread(target=add_values) for n in xrange(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            ooi.timer.flush_reports()
+            # each value is either in a report or still in the accumulator, none added to shards already reported
+            self.assertTrue(len(reports)>1)
+            self.assertEquals(80000, sum(reports) + a.get_count('step'))
+
+    def test_compact(self):
+        a = ooi.timer.Accumulator(compact=True, trigger_key='step', trigger_frequency=150, trigger_clear=False, background=False)
+        reports = []
+        a.log = lambda: reports.append(a.get_count('step'))
+        b = ooi.timer.Accumulator(trigger_key='step', trigger_frequency=150, trigger_clear=False, background=False)
+        b.log = lambda: reports.append(b.get_count('step'))
+        values = [ value/10. for value in xrange(100) ]
+        for target in a,b:
+            target.add_value('step', 20.)
+            target.add_values('step', values)
+            target.add_values('step', values)
+        self.assertEquals([201,201], reports)
+        for key in 'step', '__total__':
+            self.assertEquals(b.get_count(key), a.get_count(key))
+        for getter in 'get_min', 'get_max', 'get_average', 'get_standard_deviation', 'get_percentile':
+            self.assertAlmostEqual(getattr(b,getter)('step'), getattr(a,getter)('step'))
+        self.assertEquals(str(b), str(a))
+
+    @unittest.skipIf(ooi.timer.numpy is None, 'numpy is not installed')
+    def test_add_values_numpy(self):
+        values = [ value/10. for value in xrange(-50, 1000) ] + [ 0., 1e-12, 1e12 ]
+        a = ooi.timer.Accumulator(compact=True)
+        a.add_values('step', ooi.timer.numpy.array(values))
+        a.add_values('step', values[:10])
+        b = ooi.timer.Accumulator()
+        for value in values + values[:10]:
+            b.add_value('step', value)
+        self.assertEquals(b.get_count('step'), a.get_count('step'))
+        self.assertEquals(-5., a.get_min('step'))
+        self.assertEquals(1e12, a.get_max('step'))
+        for getter in 'get_average', 'get_standard_deviation':
+            self.assertAlmostEqual(1, getattr(a,getter)('step')/getattr(b,getter)('step'))
+        self.assertEquals(b._stats.histogram['step'].counts, a._stats.histograms[a._stats.slots['step']].counts)
+        for q in 0, 1, 50, 99, 100:
+            self.assertEquals(b.get_percentile('step', q), a.get_percentile('step', q))
+
+    def test_compact_sharded(self):
+        a = ooi.timer.Accumulator(compact=True, sharded=True)
+        def add_values():
+            a.add_values('step', [ 1., 2., 3. ])
+        threads = [ Thread(target=add_values) for n in xrange(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(12, a.get_count('step'))
+        self.assertEquals(2, a.get_average('step'))
+        self.assertEquals(3, a.get_percentile('step', 100))
+
+    def test_stable_standard_deviation(self):
+        for compact in False, True:
+            a = ooi.timer.Accumulator(compact=compact)
+            for value in xrange(100000):
+                a.add_value('step', 1e9 + value%2)
+            self.assertAlmostEqual(1e9+0.5, a.get_average('step'))
+            self.assertAlmostEqual(0.5, a.get_standard_deviation('step'))
+
+    def test_merge_and_snapshot(self):
+        whole = ooi.timer.Accumulator()
+        parts = [ ooi.timer.Accumulator(name='part', compact=True), ooi.timer.Accumulator(name='part', sharded=True) ]
+        for value in xrange(1000):
+            whole.add_value('step', value*1.5)
+            parts[value%2].add_value('step', value*1.5)
+
+        merged = ooi.timer.Accumulator()
+        merged.merge(parts[0])
+        merged.merge(ooi.timer.Accumulator.from_snapshot(json.loads(json.dumps(parts[1].snapshot()))))
+        self.assertEquals(whole.get_count('step'), merged.get_count('step'))
+        self.assertEquals(whole.get_min('step'), merged.get_min('step'))
+        self.assertEquals(whole.get_max('step'), merged.get_max('step'))
+        self.assertAlmostEqual(whole.get_average('step'), merged.get_average('step'))
+        self.assertAlmostEqual(whole.get_standard_deviation('step'), merged.get_standard_deviation('step'))
+        self.assertEquals(whole.get_percentile('step', 90), merged.get_percentile('step', 90))
+        self.assertEquals('part', ooi.timer.Accumulator.from_snapshot(parts[1].snapshot()).name)
+
+    def test_windowed(self):
+        now = [ 1000. ]
+        a = ooi.timer.WindowedAccumulator(window_seconds=60, buckets=6, trigger_key='step', trigger_frequency=7, background=False)
+        a._clock = lambda: now[0]
+        reports = []
+        a.log = lambda: reports.append(now[0])
+        for value in xrange(6):
+            now[0] = 1000. + value*10
+            a.add_value('step', float(value))
+        self.assertEquals(6, a.get_count('step'))
+        self.assertEquals(0, a.get_min('step'))
+        self.assertEquals(5, a.get_percentile('step', 100))
+
+        # oldest bucket drops out of window
+        now[0] += 10
+        self.assertEquals(5, a.get_count('step'))
+        self.assertEquals(1, a.get_min('step'))
+        self.assertEquals(3, a.get_average('step'))
+
+        # values older than window never reported
+        now[0] += 1000
+        self.assertEquals(0, a.get_count('step'))
+        a.add_values('step', [ 7., 8. ])
+        self.assertEquals(7.5, a.get_average('step'))
+        self.assertEquals([], reports)
+
+    def test_windowed_read_while_adding(self):
+        a = ooi.timer.WindowedAccumulator(window_seconds=0.5, buckets=5, trigger_key='step', trigger_frequency=1000,
+                                          trigger_clear=False, background=False, level=logging.CRITICAL)
+        def add_values():
+            for value in xrange(20000):
+                a.add_value(str(value%50), float(value)) # new labels and buckets while reading
+                a.add_value('step', float(value))
+        thread = Thread(target=add_values)
+        thread.start()
+        reads = 0
+        while thread.is_alive():
+            str(a)
+            a.get_percentile('1', 99)
+            reads += 1
+        thread.join()
+        self.assertTrue(reads>1)
+
+    def test_background_report(self):
+        a = ooi.timer.Accumulator(trigger_key='step', trigger_frequency=3, level=logging.CRITICAL)
+        reports = []
+        a._log_stats = lambda stats: reports.append((stats.get_count('step'), stats.get_max('step')))
+        for value in xrange(7):
+            a.add_value('step', float(value))
+        ooi.timer.flush_reports()
+        self.assertEquals([(3,2.),(3,5.)], reports)
+        self.assertEquals(1, a.get_count('step'))
+
+    def test_background_report_without_clear(self):
+        for sharded in False, True:
+            a = ooi.timer.Accumulator(trigger_key='step', trigger_frequency=3, trigger_clear=False, sharded=sharded, level=logging.CRITICAL)
+            reports = []
+            def log_stats(stats):
+                time.sleep(0.05) # values are added meanwhile
+                reports.append(stats.get_count('step'))
+            a._log_stats = log_stats
+            for value in xrange(7):
+                a.add_value('step', float(value))
+            ooi.timer.flush_reports()
+            # each report is a copy taken when triggered, not affected by values added later
+            self.assertEquals([3,6], reports)
+            self.assertEquals(7, a.get_count('step'))
+
+    def test_time_trigger(self):
+        a = ooi.timer.Accumulator(trigger_seconds=0.1, sharded=True)
+        reports = []
+        a._log_stats = lambda stats: reports.append(stats.get_count('step'))
+        a.add_value('step', 1.)
+        a.add_value('step', 2.)
+        time.sleep(0.25)
+        a.add_value('step', 3.)
+        time.sleep(0.1)
+        self.assertTrue(len(reports)>=2)
+        self.assertEquals(2, reports[0])
+        self.assertEquals(3, sum(reports))
+
+    def test_max_labels(self):
+        for compact in False, True:
+            # any label with more than 1/5 of values is guaranteed to be kept
+            a = ooi.timer.Accumulator(compact=compact, max_labels=5, trigger_key='trigger')
+            for n in xrange(1000):
+                a.add_value('hot', 1.)
+                a.add_value('warm', 2.) if n%2 else a.add_value('cold%d' % n, 3.)
+            a.add_value('trigger', 1.)
+            self.assertEquals(set(['__total__', '__other__', 'hot', 'warm', 'trigger']), set(a.keys()) - set([ 'cold%d' % n for n in xrange(1000) ]))
+            self.assertTrue(len(a.keys())<=8)
+            self.assertEquals(1000, a.get_count('hot'))
+            self.assertEquals(1., a.get_average('hot'))
+            self.assertTrue(a.get_count('warm')>490)
+            self.assertEquals(2., a.get_average('warm'))
+            self.assertEquals(2000, sum([ a.get_count(key) for key in a.keys() if key not in ('__total__','trigger') ]))
+
+    def test_heavy_hitters_evicts_least_frequent(self):
+        random = Random(1)
+        sketch = ooi.timer._HeavyHitters(20, exempt=('__total__',))
+        for n in xrange(20000):
+            label = 'label%d' % int(random.expovariate(0.05))
+            lowest = min(sketch.counts.values()) if len(sketch.counts)==20 else None
+            evicted_count = sketch.counts.get(sketch._least_frequent()) if lowest is not None else None
+            evicted = sketch.offer(label, random.randint(1, 3))
+            if evicted is not None:
+                self.assertEquals(lowest, evicted_count)
+            self.assertTrue(len(sketch.counts)<=20)
+            self.assertEquals(sorted(sketch.counts), sorted([ label for count,label in sketch._heap ]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,79 @@
+from unittest.case import TestCase
+import unittest
+from uuid import uuid4
+import os
+import shutil
+from ooi.aiopoller import asyncio, AsyncConditionPoller, AsyncDirectoryIterator, StopAsyncIteration, _new_future
+
+@unittest.skipUnless(asyncio, 'requires asyncio or trollius')
+class TestAsyncPollers(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dir = '/tmp/%s' % uuid4()
+        os.mkdir(self.dir)
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def run_for(self, seconds):
+        done = _new_future(self.loop)
+        self.loop.call_later(seconds, done.set_result, None)
+        self.loop.run_until_complete(done)
+
+    def get(self, future, timeout=1):
+        return self.loop.run_until_complete(asyncio.wait_for(future, timeout, loop=self.loop))
+
+    def test_condition_poller(self):
+        checks = []
+        values = []
+        errors = []
+        def condition():
+            checks.append(1)
+            if len(checks)==5:
+                raise IOError('failed')
+            return len(checks)%2
+        poller = AsyncConditionPoller(condition, values.append, errors.append, 0.01, loop=self.loop)
+        poller.start()
+        self.get(poller.wait())
+        self.assertEquals(5, len(checks))
+        self.assertEquals([1,1], values)
+        self.assertEquals(1, len(errors))
+        self.run_for(0.05)
+        self.assertEquals(5, len(checks))
+
+    def test_async_callback(self):
+        checks = []
+        def callback(value):
+            # next check waits until future from callback is done
+            future = _new_future(self.loop)
+            self.loop.call_later(0.1, future.set_result, None)
+            return future
+        poller = AsyncConditionPoller(lambda: checks.append(1) or True, callback, None, 0.01, loop=self.loop)
+        poller.start()
+        self.run_for(0.15)
+        poller.shutdown()
+        self.assertEquals(2, len(checks))
+
+    def create_file(self, name):
+        with open(self.dir+'/'+name, 'w'):
+            pass
+
+    def test_directory_iterator(self):
+        self.create_file('A001.DAT')
+        iterator = AsyncDirectoryIterator(self.dir, 'A*.DAT', interval=5, loop=self.loop)
+        self.assertEquals(self.dir+'/A001.DAT', self.get(iterator.get()))
+        self.loop.call_later(0.05, self.create_file, 'A002.DAT')
+        self.assertEquals(self.dir+'/A002.DAT', self.get(iterator.get(), timeout=0.5)) # inotify, or first check of new directory mtime
+        iterator.cancel()
+        self.assertRaises(StopAsyncIteration, self.get, iterator.get())
+
+    def test_iterator_exception(self):
+        iterator = AsyncDirectoryIterator(self.dir, 'A*.DAT', interval=0.01, inotify=False, loop=self.loop)
+        self.run_for(0.02)
+        shutil.rmtree(self.dir)
+        self.assertRaises(OSError, self.get, iterator.get())
+        self.assertRaises(StopAsyncIteration, self.get, iterator.get())
+        os.mkdir(self.dir)
+
+if __name__ == '__main__':
+    unittest.main()
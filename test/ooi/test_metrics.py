@@ -0,0 +1,86 @@
+from unittest.case import TestCase
+import unittest
+import os
+import json
+import urllib2
+from uuid import uuid4
+from threading import Thread
+import ooi.timer
+from ooi.metrics import to_prometheus, to_json, MetricsServer, SnapshotWriter
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.a = ooi.timer.Accumulator(name='test_metrics', persist=True)
+        for value in xrange(1, 101):
+            self.a.add_value('publish', value/1000.)
+        self.m = ooi.timer.Meter(name='test_metrics', persist=True)
+        self.m.mark(5)
+
+    def test_prometheus(self):
+        lines = to_prometheus().split('\n')
+        self.assertTrue('# TYPE ooi_accumulator summary' in lines)
+        self.assertTrue('ooi_accumulator_count{accumulator="test_metrics",label="publish"} 100.0' in lines)
+        p50 = [ line for line in lines if line.startswith('ooi_accumulator{accumulator="test_metrics",label="publish",quantile="0.5"}') ]
+        self.assertAlmostEqual(0.05, float(p50[0].split(' ')[1]), places=3)
+        self.assertTrue('ooi_meter_total{meter="test_metrics"} 5.0' in lines)
+
+    def test_json(self):
+        data = json.loads(json.dumps(to_json()))
+        stats = data['accumulators']['test_metrics']['publish']
+        self.assertEquals(100, stats['count'])
+        self.assertAlmostEqual(0.0505, stats['mean'])
+        self.assertAlmostEqual(0.099, stats['percentiles']['99'], places=3)
+        self.assertEquals(5, data['meters']['test_metrics']['count'])
+
+    def test_percentiles_match_accumulator(self):
+        a = ooi.timer.Accumulator(name='test_metrics_percentiles', sharded=True)
+        a.add_value('step', 0.1) # histogram bucket midpoint is not exactly 0.1
+        stats = to_json({ 'a': a }, {})['accumulators']['a']['step']
+        for q in a.percentiles:
+            self.assertEquals(0.1, stats['percentiles'][str(q)])
+            self.assertEquals(a.get_percentile('step', q), stats['percentiles'][str(q)])
+        self.assertTrue('ooi_accumulator{accumulator="a",label="step",quantile="0.99"} 0.1' in to_prometheus({ 'a': a }, {}).split('\n'))
+
+    def test_export_while_adding(self):
+        a = ooi.timer.Accumulator(name='test_metrics_concurrent', sharded=True)
+        def add_values():
+            for value in xrange(20000):
+                a.add_value(str(value%50), float(value))
+        thread = Thread(target=add_values)
+        thread.start()
+        while thread.is_alive():
+            to_prometheus({ 'a': a }, {})
+        thread.join()
+        self.assertEquals(400, to_json({ 'a': a }, {})['accumulators']['a']['1']['count'])
+
+    def test_server(self):
+        server = MetricsServer(port=0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d' % server.port
+            self.assertTrue('ooi_meter_total{meter="test_metrics"} 5.0' in urllib2.urlopen(url + '/metrics').read())
+            self.assertEquals(5, json.loads(urllib2.urlopen(url + '/metrics.json').read())['meters']['test_metrics']['count'])
+        finally:
+            server.shutdown()
+
+    def test_shutdown_server_not_started(self):
+        server = MetricsServer(port=0)
+        thread = Thread(target=server.shutdown)
+        thread.daemon = True # does not keep the test run from exiting if shutdown hangs
+        thread.start()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+    def test_snapshot_file(self):
+        filename = '/tmp/%s.json' % uuid4()
+        writer = SnapshotWriter(filename, interval=60)
+        try:
+            writer.write()
+            with open(filename) as f:
+                self.assertEquals(100, json.load(f)['accumulators']['test_metrics']['publish']['count'])
+            self.assertEquals([], [ name for name in os.listdir('/tmp') if name.startswith('.' + os.path.basename(filename)) ])
+        finally:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    unittest.main()
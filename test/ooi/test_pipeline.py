@@ -0,0 +1,144 @@
+from unittest.case import TestCase
+import unittest
+import os
+import shutil
+import pickle
+import threading
+from time import sleep
+from uuid import uuid4
+from ooi.poller import BlockingDirectoryIterator
+from ooi.pipeline import FilePipeline
+
+def file_size(filename):
+    """ module-level so it can be used with a process pool """
+    if filename.endswith('BAD.DAT'):
+        raise ValueError('bad file')
+    return os.path.getsize(filename)
+
+class NeedsTwoArgs(Exception):
+    """ pickles, but cannot be unpickled (only first argument is kept in args) """
+    def __init__(self, first, second):
+        super(NeedsTwoArgs, self).__init__(first)
+
+def fragile_file_size(filename):
+    """ module-level so it can be used with a process pool """
+    if filename.endswith('A003.DAT'):
+        return lambda: None # cannot be pickled
+    if filename.endswith('A005.DAT'):
+        raise NeedsTwoArgs('bad', 'file')
+    if filename.endswith('BAD.DAT'):
+        os._exit(1) # worker process dies
+    return os.path.getsize(filename)
+
+def slow_file_size(filename):
+    if filename.endswith('A002.DAT'):
+        sleep(30)
+    return os.path.getsize(filename)
+
+class TestFilePipeline(TestCase):
+    def setUp(self):
+        self.dir = '/tmp/%s' % uuid4()
+        os.mkdir(self.dir)
+        for n in xrange(20):
+            with open(self.dir + '/A%03d.DAT' % n, 'w') as f:
+                f.write('x'*n)
+        with open(self.dir + '/A010BAD.DAT', 'w'):
+            pass
+    def tearDown(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+    def collect(self, pipeline, count):
+        results = []
+        for result in pipeline.results():
+            results.append(result)
+            if len(results)==count:
+                break
+        pipeline.close()
+        return results
+
+    def test_ordered(self):
+        files = BlockingDirectoryIterator(self.dir, 'A*.DAT', 0.05)
+        results = self.collect(FilePipeline(files, file_size, workers=4), 21)
+        names = [ filename.split('/')[-1] for filename,result,exception in results ]
+        self.assertEqual(sorted(names), names)
+        self.assertEqual(range(20), [ result for filename,result,exception in results if not exception ])
+        failed = [ filename for filename,result,exception in results if exception ]
+        self.assertEqual([self.dir + '/A010BAD.DAT'], failed)
+
+    def test_processes(self):
+        files = BlockingDirectoryIterator(self.dir, 'A*.DAT', 0.05)
+        results = self.collect(FilePipeline(files, file_size, workers=2, processes=True), 21)
+        self.assertEqual(range(20), [ result for filename,result,exception in results if not exception ])
+        self.assertTrue(isinstance(results[11][2], ValueError))
+
+    def test_process_failures(self):
+        for ordered in True, False:
+            files = sorted([ self.dir + '/' + name for name in os.listdir(self.dir) ])
+            pipeline = FilePipeline(files, fragile_file_size, workers=2, processes=True, ordered=ordered)
+            results = dict([ (filename.split('/')[-1], (result, exception)) for filename,result,exception in pipeline ])
+            pipeline.close()
+            # every file gets exactly one result, even if the pool could not return it
+            self.assertEqual(21, len(results))
+            self.assertEqual((7, None), results['A007.DAT'])
+            self.assertTrue(isinstance(results['A003.DAT'][1], pickle.PicklingError))
+            self.assertTrue(isinstance(results['A005.DAT'][1], TypeError))
+            self.assertTrue(isinstance(results['A010BAD.DAT'][1], RuntimeError))
+
+    def test_close_stops_results(self):
+        for processes in False, True:
+            files = sorted([ self.dir + '/' + name for name in os.listdir(self.dir) ])
+            pipeline = FilePipeline(files, slow_file_size, workers=2, processes=processes)
+            results = []
+            consumer = threading.Thread(target=lambda: results.extend(pipeline))
+            consumer.start()
+            sleep(0.2)
+            pipeline.close() # consumer is waiting for A002.DAT
+            consumer.join(2)
+            self.assertFalse(consumer.is_alive())
+            self.assertEqual([0, 1], [ result for filename,result,exception in results ])
+
+    def test_unordered_bounded(self):
+        in_flight = [ 0, 0 ]
+        lock = threading.Lock()
+        def slow(filename):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            sleep(0.2 if filename.endswith('A000.DAT') else 0.01)
+            with lock:
+                in_flight[0] -= 1
+            return filename
+        filenames = sorted([ self.dir + '/' + name for name in os.listdir(self.dir) ])
+        pipeline = FilePipeline(filenames, slow, workers=3, max_in_flight=5, ordered=False)
+        results = [ filename for filename,result,exception in pipeline ]
+        self.assertEqual(sorted(filenames), sorted(results))
+        self.assertNotEqual(filenames[0], results[0]) # slow first file did not hold back others
+        self.assertTrue(in_flight[1]<=3)
+
+    def test_max_in_flight(self):
+        processed = []
+        def record(filename):
+            processed.append(filename)
+            return filename
+        filenames = sorted([ self.dir + '/' + name for name in os.listdir(self.dir) ])
+        # more workers than max_in_flight: only the limit on untaken results can stop submitting
+        pipeline = FilePipeline(filenames, record, workers=8, max_in_flight=4, ordered=False)
+        results = pipeline.results()
+        taken = [ results.next(), results.next() ]
+        sleep(0.2) # consumer stops taking results
+        self.assertEqual(len(taken)+4, len(processed))
+        taken += list(results)
+        self.assertEqual(sorted(filenames), sorted([ filename for filename,result,exception in taken ]))
+        pipeline.close()
+
+    def test_poller_exception(self):
+        files = BlockingDirectoryIterator(self.dir, 'A*.DAT', 0.02, inotify=False)
+        pipeline = FilePipeline(files, file_size)
+        results = pipeline.results()
+        self.assertEqual(0, results.next()[1])
+        shutil.rmtree(self.dir)
+        self.assertRaises(OSError, list, results)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,14 @@
 
-from ooi.poller import BlockingDirectoryIterator
+import ooi.poller
+from ooi.poller import BlockingDirectoryIterator, DirectoryPoller, ConditionPoller, PollScheduler, StableFile, MarkerFile, ClosedFile
+import threading
 from unittest.case import TestCase
 import unittest
 
 from uuid import uuid4
 import os
 import shutil
-from gevent import spawn
+from threading import Thread
 from time import sleep
 
 class TestFileIteration(TestCase):
@@ -23,33 +25,73 @@ class TestFileIteration(TestCase):
         """
         self.exception = None
         self.values = []
-        self.target = BlockingDirectoryIterator(self.dir,'A*.DAT',.1)
-        thread = spawn(self._listen_for_files)
+        self.target = BlockingDirectoryIterator(self.dir,'A*.DAT',.1,inotify=False)
+        thread = Thread(target=self._listen_for_files)
+        thread.daemon = True
+        thread.start()
 
         # can read existing files
-        self._create_file('A001.DAT')
         self._create_file('A002.DAT')
+        self._create_file('A001.DAT')
         sleep(0.25)
         self.assertEqual(['A001.DAT','A002.DAT'], self.values)
 
         # responds to new files added
         self._create_file('A003.DAT')
         self._create_file('A004.DAT')
-        sleep(0.1)
+        sleep(0.25)
         self.assertEqual(['A001.DAT','A002.DAT','A003.DAT','A004.DAT'], self.values)
 
-        # ignores files out of sequence
+        # files out of sequence are reported too
         self._create_file('A005.DAT')
         self._create_file('A000.DAT')
-        sleep(0.1)
-        self.assertEqual(['A001.DAT','A002.DAT','A003.DAT','A004.DAT','A005.DAT'], self.values)
+        self._create_file('B000.DAT')
+        sleep(0.25)
+        self.assertEqual(['A001.DAT','A002.DAT','A003.DAT','A004.DAT','A000.DAT','A005.DAT'], self.values)
 
-        # fails when file removed
+        # removed files are forgotten, polling continues
         os.remove(self.dir+'/A005.DAT')
-        sleep(0.2)
-        self.assertEqual(['A001.DAT','A002.DAT','A003.DAT','A004.DAT','A005.DAT'], self.values)
-        self.assertTrue(thread.dead)
-        self.assertTrue(self.exception is not None)
+        os.remove(self.dir+'/A001.DAT')
+        self._create_file('A006.DAT')
+        sleep(0.25)
+        self.assertEqual(['A001.DAT','A002.DAT','A003.DAT','A004.DAT','A000.DAT','A005.DAT','A006.DAT'], self.values)
+        self.assertTrue(thread.is_alive())
+        self.assertTrue(self.exception is None)
+        self.target.cancel()
+
+    def testSkipUnchangedDirectory(self):
+        poller = DirectoryPoller(self.dir, 'A*.DAT', None, inotify=False)
+        self._create_file('A001.DAT')
+        self.assertEqual([self.dir+'/A001.DAT'], poller._check_for_files())
+        # directory mtime just changed: scan again in case files were added within the same clock tick
+        poller._matching_names = lambda low: set(['A001.DAT','A002.DAT'])
+        self.assertEqual([self.dir+'/A002.DAT'], poller._check_for_files())
+        # unchanged since well before the last scan: listing is skipped
+        poller._scan_time += 5
+        poller._matching_names = lambda low: self.fail('should not list directory')
+        self.assertEqual(None, poller._check_for_files())
+
+    def testBoundedScan(self):
+        poller = DirectoryPoller(self.dir, 'A*.DAT', None, inotify=False)
+        def scan():
+            # directory mtime is always recent here, so every scan lists it
+            return [ filename.split('/')[-1] for filename in poller._scan(None, limit=3)[0] ]
+        for n in xrange(1, 6):
+            self._create_file('A%03d.DAT' % n)
+        self.assertEqual(['A001.DAT','A002.DAT','A003.DAT','A004.DAT','A005.DAT'], scan())
+        self.assertEqual(set(['A003.DAT','A004.DAT','A005.DAT']), poller._known)
+
+        # out of order file within the last names remembered is reported, one before them is not
+        for name in 'A000.DAT', 'A0035.DAT', 'A006.DAT':
+            self._create_file(name)
+        self.assertEqual(['A0035.DAT','A006.DAT'], scan())
+        self.assertEqual(3, len(poller._known))
+
+        # removed file is forgotten, and reported again if added again
+        os.remove(self.dir+'/A005.DAT')
+        self.assertEqual([], scan())
+        self._create_file('A005.DAT')
+        self.assertEqual(['A005.DAT'], scan())
 
     def _create_file(self, name):
         with file(self.dir+'/'+name,'w+'):
@@ -61,7 +103,287 @@ class TestFileIteration(TestCase):
                 self.values.append(f.split('/')[-1])
         except Exception as e:
             self.exception = e
+    def testBackpressure(self):
+        for n in xrange(10):
+            self._create_file('A%03d.DAT' % n)
+        for inotify in False, True:
+            target = BlockingDirectoryIterator(self.dir, 'A*.DAT', 0.02, inotify=inotify, max_queued=3)
+            sleep(0.1)
+            self.assertEqual(3, target._values.qsize())
+            self.assertTrue(target._poller._paused)
+            batches = target.get_batches(max_size=2, max_wait=0.1)
+            values = []
+            while len(values)<10:
+                batch = batches.next()
+                self.assertTrue(1<=len(batch)<=2)
+                self.assertTrue(target._values.qsize()<=3)
+                values += [ f.split('/')[-1] for f in batch ]
+            self.assertEqual([ 'A%03d.DAT' % n for n in xrange(10) ], values)
+            target.cancel()
+
+    def testBatchException(self):
+        self._create_file('A000.DAT')
+        target = BlockingDirectoryIterator(self.dir, 'A*.DAT', 0.02, inotify=False)
+        sleep(0.1)
+        shutil.rmtree(self.dir)
+        sleep(0.1)
+        batches = target.get_batches(max_size=10, max_wait=1)
+        self.assertEqual([self.dir+'/A000.DAT'], batches.next())
+        self.assertRaises(OSError, batches.next)
+        os.mkdir(self.dir)
+
+class TestDirectoryPoller(TestCase):
+    def setUp(self):
+        self.dir = '/tmp/%s' % uuid4()
+        os.mkdir(self.dir)
+        self.values = []
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _on_files(self, filenames):
+        self.values.extend([ f.split('/')[-1] for f in filenames ])
+
+    @unittest.skipUnless(ooi.poller._libc, 'inotify not available')
+    def testInotify(self):
+        with open(self.dir+'/A001.DAT', 'w'):
+            pass
+        poller = DirectoryPoller(self.dir, 'A*.DAT', self._on_files, interval=0.5)
+        self.assertTrue(poller._inotify is not None)
+        poller.start()
+        try:
+            sleep(0.05)
+            self.assertEqual(['A001.DAT'], self.values)
+
+            # reported when closed, well before the next interval
+            f = open(self.dir+'/A002.DAT', 'w')
+            f.write('data')
+            f.flush()
+            with open(self.dir+'/B001.DAT', 'w'):
+                pass
+            sleep(0.05)
+            self.assertEqual(['A001.DAT'], self.values)
+            f.close()
+            sleep(0.05)
+            self.assertEqual(['A001.DAT','A002.DAT'], self.values)
+
+            # out of order files and renamed files reported too, rewritten files are not reported again
+            with open(self.dir+'/A000.DAT', 'w'):
+                pass
+            with open(self.dir+'/A002.DAT', 'a'):
+                pass
+            with open(self.dir+'/tmp', 'w'):
+                pass
+            os.rename(self.dir+'/tmp', self.dir+'/A003.DAT')
+            sleep(0.05)
+            self.assertEqual(['A001.DAT','A002.DAT','A000.DAT','A003.DAT'], self.values)
+        finally:
+            poller.shutdown()
+            poller.join()
+
+    def testNoInotify(self):
+        poller = DirectoryPoller(self.dir, 'A*.DAT', self._on_files, interval=0.05, inotify=False)
+        self.assertTrue(poller._inotify is None)
+        poller.start()
+        try:
+            with open(self.dir+'/A001.DAT', 'w'):
+                pass
+            sleep(0.2)
+            self.assertEqual(['A001.DAT'], self.values)
+        finally:
+            poller.shutdown()
+            poller.join()
+
+    def _names(self, filenames):
+        return [ f.split('/')[-1] for f in filenames ] if filenames else filenames
+
+    def testStableFile(self):
+        poller = DirectoryPoller(self.dir, 'A*.DAT', None, inotify=False, ready=StableFile())
+        f = open(self.dir+'/A001.DAT', 'w')
+        f.write('data')
+        f.flush()
+        self.assertEqual(None, poller._check_for_files())
+        # still growing
+        f.write('more')
+        f.flush()
+        self.assertEqual(None, poller._check_for_files())
+        f.close()
+        self.assertEqual(['A001.DAT'], self._names(poller._check_for_files()))
+        self.assertEqual(None, poller._check_for_files())
+
+        # removed before it was complete: never reported
+        with open(self.dir+'/A002.DAT', 'w'):
+            pass
+        self.assertEqual(None, poller._check_for_files())
+        os.remove(self.dir+'/A002.DAT')
+        self.assertEqual(None, poller._check_for_files())
+        self.assertEqual({}, poller._ready._waiting)
+
+    def testMarkerFile(self):
+        poller = DirectoryPoller(self.dir, 'A*', None, inotify=False, ready=MarkerFile())
+        with open(self.dir+'/A001.DAT', 'w'):
+            pass
+        with open(self.dir+'/A002.DAT', 'w'):
+            pass
+        self.assertEqual(None, poller._check_for_files())
+        self.assertEqual(None, poller._check_for_files())
+        with open(self.dir+'/A002.DAT.done', 'w'):
+            pass
+        self.assertEqual(['A002.DAT'], self._names(poller._check_for_files()))
+        with open(self.dir+'/A001.DAT.done', 'w'):
+            pass
+        self.assertEqual(['A001.DAT'], self._names(poller._check_for_files()))
+        self.assertEqual(None, poller._check_for_files())
+
+    @unittest.skipUnless(ooi.poller._libc, 'inotify not available')
+    def testClosedFile(self):
+        with open(self.dir+'/A001.DAT', 'w'):
+            pass
+        poller = DirectoryPoller(self.dir, 'A*.DAT', None, ready=ClosedFile())
+        try:
+            # found by listing the directory: cannot tell if it is complete, so wait until it is stable
+            self.assertEqual(None, poller._check_for_events())
+            with open(self.dir+'/A002.DAT', 'w') as f:
+                f.write('data')
+            # closed after writing: reported at once
+            self.assertEqual(['A001.DAT','A002.DAT'], self._names(poller._check_for_events()))
+            self.assertEqual(None, poller._check_for_events())
+        finally:
+            poller._on_stopped()
+
+class TestPollScheduler(TestCase):
+    def testManyPollers(self):
+        scheduler = PollScheduler()
+        threads = threading.active_count()
+        counts = [ 0 ]*50
+        def condition(index):
+            counts[index] += 1
+            return index
+        called = []
+        errors = []
+        pollers = [ ConditionPoller(lambda index=index: condition(index), called.append, None, 0.05 if index else 0.01, scheduler=scheduler)
+                    for index in xrange(50) ]
+        def fail():
+            raise IOError('condition failed')
+        failing = ConditionPoller(fail, None, errors.append, 0.01, scheduler=scheduler)
+        for poller in pollers + [ failing ]:
+            poller.start()
+        self.assertEqual(threads+1, threading.active_count())
+        sleep(0.22)
+        for poller in pollers:
+            poller.shutdown()
+        for poller in pollers:
+            poller.join(1)
+        # each poller checked at its own interval, exception stops only the failing poller
+        self.assertTrue(15<=counts[0]<=23, counts[0])
+        self.assertTrue(all([ 4<=count<=6 for count in counts[1:] ]), counts)
+        self.assertEqual(sum(counts)-counts[0], len(called)) # condition of first poller returns 0: no callback
+        self.assertEqual(1, len(errors))
+        self.assertTrue(failing._finished.is_set())
+        total = sum(counts)
+        sleep(0.1)
+        self.assertEqual(total, sum(counts))
+        scheduler.shutdown()
+        scheduler.join(1)
+
+    def testWorkerPool(self):
+        scheduler = PollScheduler(threads=3)
+        def slow():
+            sleep(0.1)
+        checks = []
+        slow_poller = ConditionPoller(slow, None, None, 0.01, scheduler=scheduler)
+        fast_poller = ConditionPoller(lambda: checks.append(1), None, None, 0.01, scheduler=scheduler)
+        slow_poller.start()
+        fast_poller.start()
+        sleep(0.2)
+        slow_poller.shutdown()
+        fast_poller.shutdown()
+        fast_poller.join(1)
+        slow_poller.join(1)
+        self.assertTrue(slow_poller._finished.is_set())
+        self.assertTrue(len(checks)>10) # not delayed by slow poller
+        scheduler.shutdown()
+        scheduler.join(1)
+
+    def testShutdown(self):
+        threads = threading.active_count()
+        scheduler = PollScheduler(threads=2)
+        def slow():
+            sleep(0.1)
+        pollers = [ ConditionPoller(slow, None, None, 0.01, scheduler=scheduler) for n in xrange(3) ]
+        for poller in pollers:
+            poller.start()
+        sleep(0.05)
+        self.assertEqual(threads+3, threading.active_count())
+        wake = scheduler._wake_read, scheduler._wake_write
+        scheduler.shutdown()
+        scheduler.join(1)
+        # all pollers stopped, checks running at shutdown finished first
+        self.assertFalse(scheduler.is_alive())
+        self.assertTrue(all([ poller._finished.is_set() for poller in pollers ]))
+        self.assertEqual(set(), scheduler._checking)
+        self.assertEqual(threads, threading.active_count())
+        for fd in wake:
+            self.assertRaises(OSError, os.fstat, fd)
+        self.assertRaises(ValueError, ConditionPoller(slow, None, None, 0.01, scheduler=scheduler).start)
+
+        # never started
+        scheduler = PollScheduler()
+        scheduler.shutdown()
+        self.assertEqual(None, scheduler._wake_write)
+
+    @unittest.skipUnless(ooi.poller._libc, 'inotify not available')
+    def testInotifyPoller(self):
+        directory = '/tmp/%s' % uuid4()
+        os.mkdir(directory)
+        try:
+            scheduler = PollScheduler()
+            values = []
+            poller = DirectoryPoller(directory, '*.DAT', values.extend, interval=10, scheduler=scheduler)
+            poller.start()
+            sleep(0.05)
+            with open(directory+'/A001.DAT', 'w'):
+                pass
+            sleep(0.05)
+            self.assertEqual([directory+'/A001.DAT'], values) # long before interval
+            poller.shutdown()
+            poller.join(1)
+            self.assertTrue(poller._finished.is_set())
+            self.assertEqual({}, scheduler._fds)
+            scheduler.shutdown()
+            scheduler.join(1)
+        finally:
+            shutil.rmtree(directory)
+class TestAdaptiveInterval(TestCase):
+    def testBackoff(self):
+        values = [ 0, 0, 0, 0, 0, 1, 1, 1, 1, 0 ]
+        poller = ConditionPoller(lambda: values.pop(0), lambda value: None, None, 1, min_interval=0.1, max_interval=10)
+        intervals = []
+        for n in xrange(10):
+            poller._check_condition()
+            intervals.append(poller.polling_interval)
+        self.assertEqual([2, 4, 8, 10, 10, 5, 2.5, 1.25, 0.625, 1.25], intervals)
+        stats = poller.get_stats()
+        self.assertEqual(10, stats['checks'])
+        self.assertEqual(4, stats['found'])
+        self.assertEqual(1.25, stats['interval'])
+        self.assertTrue(0<=stats['average_check_seconds']<=stats['max_check_seconds'])
+
+    def testFixedInterval(self):
+        poller = ConditionPoller(lambda: 1, lambda value: None, None, 0.5)
+        poller._check_condition()
+        self.assertEqual(0.5, poller.polling_interval)
 
+    def testScheduledBackoff(self):
+        checks = []
+        scheduler = PollScheduler()
+        poller = ConditionPoller(lambda: checks.append(1), None, None, 0.01, scheduler=scheduler, max_interval=0.08)
+        poller.start()
+        sleep(0.3)
+        scheduler.shutdown()
+        scheduler.join(1)
+        self.assertTrue(poller._finished.is_set())
+        # intervals 0.02, 0.04, 0.08, 0.08...: about 6 checks instead of 30
+        self.assertTrue(4<=len(checks)<=8, len(checks))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+from unittest.case import TestCase
+import unittest
+import os
+import shutil
+import pstats
+from uuid import uuid4
+import ooi.timer
+from ooi.profiling import AutoProfiler
+
+class TestAutoProfiler(TestCase):
+    def setUp(self):
+        self.dir = '/tmp/%s' % uuid4()
+        os.mkdir(self.dir)
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def work(self, profiler, n):
+        t = ooi.timer.Timer()
+        with profiler.profile('work'):
+            sum(xrange(n))
+        t.complete_step('work')
+        profiler.check(t)
+
+    def test_profile_after_slow_step(self):
+        profiler = AutoProfiler(self.dir, thresholds={ 'work': 0.01 }, executions=3, min_interval=0, max_sessions=1)
+        self.work(profiler, 10)
+        self.assertEquals([], profiler.files)
+
+        # slow step starts profiling of next 3 executions
+        self.work(profiler, 5000000)
+        self.assertEquals([], profiler.files)
+        for n in xrange(3):
+            self.work(profiler, 10)
+        self.assertEquals(1, len(profiler.files))
+        stats = pstats.Stats(profiler.files[0])
+        self.assertTrue([ key for key in stats.stats.keys() if key[2]=='<sum>' ])
+
+        # max_sessions reached
+        self.work(profiler, 5000000)
+        self.assertFalse(profiler.start('work'))
+        self.assertEquals(1, len(os.listdir(self.dir)))
+
+    def test_percentile_threshold(self):
+        a = ooi.timer.Accumulator()
+        for n in xrange(100):
+            a.add_value('work', 0.001)
+        profiler = AutoProfiler(self.dir, accumulator=a, percentile=99, executions=1)
+        self.work(profiler, 10)
+        self.assertFalse('work' in profiler._sessions)
+        self.work(profiler, 5000000)
+        self.assertTrue('work' in profiler._sessions)
+        self.assertFalse(profiler.start('work')) # rate limited: min_interval
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+from unittest.case import TestCase
+import unittest
+import os
+from uuid import uuid4
+import ooi.timer
+from ooi.sharedstats import SharedAccumulator, aggregate, read_entries
+
+class TestSharedStats(TestCase):
+    def setUp(self):
+        self.filename = '/tmp/%s.stats' % uuid4()
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_processes(self):
+        s = SharedAccumulator(self.filename, processes=4, labels=4)
+        s.add_value('publish', 0.001)
+        children = []
+        for n in xrange(3):
+            pid = os.fork()
+            if not pid:
+                # child inherits s, but must write into a slot of its own
+                try:
+                    for value in xrange(100):
+                        s.add_value('publish', 0.002)
+                    t = ooi.timer.Timer()
+                    t.complete_step('persist')
+                    s.add(t)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        self.assertEquals(4, len(set([ entry[0] for entry in read_entries(self.filename) ])))
+        a = aggregate(self.filename)
+        self.assertEquals(301, a.get_count('publish'))
+        self.assertEquals(3, a.get_count('persist'))
+        self.assertEquals(3, a.get_count())
+        self.assertAlmostEqual(0.001, a.get_min('publish'))
+        self.assertAlmostEqual(0.002, a.get_percentile('publish', 50), places=4)
+        self.assertAlmostEqual((0.001+300*0.002)/301, a.get_average('publish'))
+
+        # children exited: their slots are reused, or left out with live_only
+        self.assertEquals(1, aggregate(self.filename, live_only=True).get_count('publish'))
+        SharedAccumulator(self.filename).add_value('publish', 1.)
+        self.assertEquals(202, aggregate(self.filename).get_count('publish'))
+
+    def test_label_limit(self):
+        s = SharedAccumulator(self.filename, processes=1, labels=3)
+        for label in 'a', 'b', 'c', 'd':
+            s.add_value(label, 1.)
+        a = aggregate(self.filename)
+        self.assertEquals([1, 1, 0, 0], [ a.get_count(label) for label in 'abcd' ])
+        self.assertEquals(2, a.get_count('__other__'))
+
+if __name__ == '__main__':
+    unittest.main()
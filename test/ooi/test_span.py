@@ -0,0 +1,57 @@
+from unittest.case import TestCase
+import unittest
+import time
+import os
+from uuid import uuid4
+from ooi.span import SpanTimer, SpanAccumulator
+
+class TestSpan(TestCase):
+    def operation(self):
+        t = SpanTimer()
+        with t.span('dispatch'):
+            time.sleep(0.005)
+            with t.span('decode'):
+                time.sleep(0.01)
+            with t.span('persist'):
+                with t.span('validate'):
+                    time.sleep(0.005)
+                time.sleep(0.01)
+        return t
+
+    def test_default_name(self):
+        # named after the module creating them, not ooi.span
+        self.assertEquals('timing.' + __name__, SpanTimer().logger.name)
+        self.assertEquals('stats.' + __name__, SpanAccumulator().logger.name)
+
+    def test_timer_tree(self):
+        t = self.operation()
+        self.assertEquals(1, len(t.roots))
+        self.assertEquals(['decode','persist'], [ span.name for span in t.roots[0].children ])
+        self.assertAlmostEqual(0.03, t.roots[0].elapsed, places=2)
+        self.assertAlmostEqual(0.005, t.roots[0].get_self_time(), places=2)
+        self.assertEquals(4, len(str(t).split('\n')))
+
+    def test_aggregate(self):
+        a = SpanAccumulator()
+        a.add(self.operation())
+        a.add(self.operation())
+        self.assertEquals(4, len(a.paths()))
+        self.assertEquals(2, a.get_count(('dispatch','persist','validate')))
+        self.assertAlmostEqual(0.03, a.get_total('dispatch;persist'), places=2)
+        self.assertAlmostEqual(0.02, a.get_self_time('dispatch;persist'), places=2)
+        self.assertEquals(0, a.get_count('dispatch;other'))
+
+        folded = a.folded()
+        self.assertEquals('dispatch;decode', folded[1].split(' ')[0])
+        self.assertAlmostEqual(20000, int(folded[1].split(' ')[1]), delta=5000)
+
+        filename = '/tmp/%s.folded' % uuid4()
+        try:
+            a.write_folded(filename)
+            with open(filename) as f:
+                self.assertEquals(folded, f.read().splitlines())
+        finally:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    unittest.main()
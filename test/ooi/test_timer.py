@@ -3,6 +3,7 @@ import unittest
 import time
 import ooi.timer
 from math import fabs
+from threading import Thread
 class TestTimer(TestCase):
     def setUp(self):
         self.op1_times = iter([ .01, .02 ])
@@ -27,6 +28,160 @@ class TestTimer(TestCase):
         t.complete_step()
 
         self.assertEquals(3, len(t.times))
+        self.assertTrue(str(t).startswith('elapsed'))
+        self.assertTrue(' pause=' in str(t))
+
+    def test_monotonic_timer(self):
+        a = ooi.timer.Accumulator()
+        t = ooi.timer.MonotonicTimer(capacity=1)
+        time.sleep(0.01)
+        t.complete_step('pause')
+        with t.step('block'):
+            time.sleep(0.02)
+        time.sleep(0.01)
+        t.complete_step()
+        self.assertEquals(['pause','block',None], [ label for label,delta in t.get_steps() ])
+        self.assertEquals(4, len(t.times))
+        self.assertAlmostEqual(0.02, t.get_steps()[1][1], places=2)
+        self.assertAlmostEqual(0.04, t._elapsed(), places=2)
+        a.add(t)
+        self.assertEquals(['2','__total__','block','pause'], sorted(a.keys()))
+
+        # storage grows from nothing too
+        t = ooi.timer.MonotonicTimer(capacity=0)
+        for n in xrange(10):
+            t.complete_step(str(n))
+        with t.step('block'):
+            pass
+        self.assertEquals([ str(n) for n in xrange(10) ] + ['block'], [ label for label,delta in t.get_steps() ])
+
+    def test_timed(self):
+        a = ooi.timer.Accumulator()
+        @ooi.timer.timed(a)
+        def pause(seconds):
+            time.sleep(seconds)
+            return seconds
+        self.assertEquals(0.01, pause(0.01))
+        self.assertEquals(1, a.get_count('pause'))
+        self.assertAlmostEqual(0.01, a.get_average('pause'), places=2)
+
+    def test_slow_log(self):
+        slow = ooi.timer.SlowLog(size=2)
+        for pause in 0.001, 0.02, 0.005, 0.03, 0.002:
+            t = ooi.timer.Timer(name='op')
+            time.sleep(pause)
+            t.complete_step('pause')
+            slow.add(t)
+        slowest = slow.get_slowest('op')
+        self.assertEquals(2, len(slowest))
+        self.assertAlmostEqual(0.03, slowest[0][0], places=2)
+        self.assertAlmostEqual(0.02, slowest[1][0], places=2)
+        self.assertEquals('pause', slowest[0][2][0][0])
+        self.assertEquals(['op'], slow.names())
+        self.assertEquals(3, len(str(slow).split('\n')))
+
+    def test_sampler(self):
+        a = ooi.timer.Accumulator()
+        sampler = ooi.timer.Sampler(a, rate=10)
+        for n in xrange(100):
+            t = sampler.start()
+            t.complete_step('work')
+            sampler.add(t)
+        self.assertEquals(100, a.get_count('work'))
+        self.assertTrue(str(a).startswith('sampling 1 in 10 calls'))
+
+    def test_adaptive_sampler(self):
+        a = ooi.timer.Accumulator()
+        sampler = ooi.timer.Sampler(a, samples_per_second=200, adjust_seconds=0.05)
+        calls = 0
+        end = time.time()+0.3
+        while time.time()<end:
+            t = sampler.start()
+            t.complete_step('work')
+            sampler.add(t)
+            calls += 1
+        self.assertTrue(sampler.rate>1)
+        self.assertAlmostEqual(1, float(a.get_count('work'))/calls, delta=0.2)
+
+    def test_cpu_time(self):
+        a = ooi.timer.Accumulator()
+        t = ooi.timer.Timer(cpu=True)
+        time.sleep(0.05)
+        t.complete_step('wait')
+        end = time.time()+0.05
+        while time.time()<end:
+            pass
+        t.complete_step('compute')
+        a.add(t)
+        self.assertTrue(a.get_average('wait.cpu')<0.01)
+        # busy loop uses CPU for most of its time, even if other processes compete for it
+        self.assertTrue(0.025<a.get_average('compute.cpu')<=a.get_average('compute')+0.001)
+        self.assertAlmostEqual(a.get_average('wait.cpu')+a.get_average('compute.cpu'), a.get_average('__total__.cpu'))
+        self.assertEquals([], ooi.timer.Timer().get_resource_steps())
+
+    def test_thread_cpu_clock_per_thread(self):
+        clock = ooi.timer._thread_cpu_clock
+        if not clock:
+            return
+        stop = []
+        def read_clock():
+            while not stop:
+                clock()
+        thread = Thread(target=read_clock)
+        thread.start()
+        try:
+            # readings by another thread never show up as this thread's CPU time
+            last = clock()
+            for n in xrange(100000):
+                now = clock()
+                self.assertTrue(now>=last)
+                last = now
+        finally:
+            stop.append(True)
+            thread.join()
+
+    def test_unavailable_resource_warns_once(self):
+        warnings = []
+        warning, ooi.timer.log.warning = ooi.timer.log.warning, warnings.append
+        try:
+            ooi.timer._resource_readers.clear()
+            ooi.timer._resource_warnings.clear()
+            tracemalloc, ooi.timer.tracemalloc = ooi.timer.tracemalloc, None
+            for n in xrange(100):
+                t = ooi.timer.Timer(memory=True)
+                t.complete_step()
+            self.assertEquals([], t.get_resource_steps())
+            self.assertEquals(['tracemalloc is not tracing, Timer will not record memory allocated'], warnings)
+            self.assertTrue(ooi.timer.Timer(memory=True)._resources is t._resources)
+        finally:
+            ooi.timer.log.warning = warning
+            ooi.timer.tracemalloc = tracemalloc
+            ooi.timer._resource_readers.clear()
+
+    def test_meter(self):
+        now = [ 1000. ]
+        m = ooi.timer.Meter(name='test_meter', persist=True)
+        m._clock = lambda: now[0]
+        m.clear()
+        self.assertTrue(ooi.timer.get_meters()['test_meter'] is m)
+        self.assertEquals(0, m.get_one_minute_rate())
+
+        # steady 10 events per second
+        for second in xrange(60):
+            now[0] = 1000. + second
+            m.mark(10)
+        now[0] = 1060.
+        self.assertEquals(600, m.get_count())
+        self.assertAlmostEqual(10, m.get_mean_rate())
+        self.assertAlmostEqual(10, m.get_one_minute_rate())
+        self.assertAlmostEqual(10, m.get_fifteen_minute_rate())
+
+        # idle: short window decays faster than long one, mean rate falls as 1/time
+        now[0] = 1120.
+        self.assertAlmostEqual(10/2.718, m.get_one_minute_rate(), places=1)
+        self.assertTrue(m.get_five_minute_rate()>m.get_one_minute_rate())
+        self.assertAlmostEqual(5, m.get_mean_rate())
+        self.assertTrue(str(m).startswith('600 events, mean 5.00/sec, 1min 3.68/sec'))
 
     def one_step_operation(self):
         t = ooi.timer.Timer()
@@ -44,7 +199,7 @@ class TestTimer(TestCase):
         self.assertEquals(2, self.a1.get_count())
         self.assertAlmostEqual(self.a1.get_average(), 0.015, places=3 )
         self.assertTrue( fabs(self.a1.get_average()-0.015)<.001 )
-        self.assertEquals(0, self.a1.get_standard_deviation())
+        self.assertAlmostEqual(0.005, self.a1.get_standard_deviation(), places=3) # samples 0.01 and 0.02
 
 
     def two_step_operation(self):